@@ -0,0 +1,91 @@
+"""
+Per-event cost of matching reaction emoji against 5, 50 and 500 reaction groups: checking every
+group in turn, ReactionGroupMatcher without its memo (the combined filters alone), and with it.
+
+    python bench/reaction_groups.py [--events 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tomllib
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# cogs.reactions reads its settings from main, which would start the bot if imported
+main = types.ModuleType('main')
+with open(os.path.join(ROOT, 'config.example.toml'), 'rb') as file:
+    main.config = tomllib.load(file)
+main.command_guild_ids = []
+sys.modules['main'] = main
+
+from cogs.reactions import ReactionGroupMatcher, Reactions  # noqa: E402
+
+WORDS = ['pog', 'kek', 'lul', 'omega', 'sad', 'cope', 'neuro', 'evil', 'copium', 'based', 'cringe', 'wah']
+# A mix of unicode, flag and custom emoji, most of which hit no group
+EMOJI = ['👍', '😂', '🇯🇵', '<:neuroPog:123456789012345678>', '❤️', '🔥', '<a:dance:987654321098765432>', 'pog5']
+
+
+def make_groups(count: int) -> list[tuple[str, bool, str, int]]:
+    random.seed(count)
+    groups = [('flags', True, r'[\U0001F1E6-\U0001F1FF]{2}', Reactions.MATCH_TYPE_SUBSTRING)]
+    while len(groups) < count:
+        word = random.choice(WORDS) + str(len(groups))
+        (match, match_type) = random.choice([
+            (word, Reactions.MATCH_TYPE_EXACT),
+            (f'^{word}$', Reactions.MATCH_TYPE_EXACT),
+            (f'{word}[a-z]*', Reactions.MATCH_TYPE_SUBSTRING),
+            (f'(?:{word}|x{word})', Reactions.MATCH_TYPE_SUBSTRING),
+        ])
+        groups.append((f'group{len(groups)}', True, match, match_type))
+    return groups
+
+
+def every_group(matcher: ReactionGroupMatcher, emoji: str) -> list[tuple[str, bool]]:
+    """
+    Checks each group in turn, as matching did before the combined filters and memo.
+    """
+    emoji_name = emoji.split(':')[1] if ':' in emoji else emoji
+    hit_groups = []
+    for (name, enabled, match, match_type, pattern) in matcher.groups:
+        if match_type == Reactions.MATCH_TYPE_SUBSTRING:
+            if pattern.search(emoji):
+                hit_groups.append((name, enabled))
+        elif match_type == Reactions.MATCH_TYPE_EXACT:
+            if emoji == match or pattern.search(emoji_name):
+                hit_groups.append((name, enabled))
+    return hit_groups
+
+
+def per_event(match, stream: list[str]) -> float:
+    start = time.perf_counter()
+    for emoji in stream:
+        match(emoji)
+    return (time.perf_counter() - start) / len(stream) * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(f'{"groups":>6} {"every group":>12} {"uncached":>10} {"memoized":>10}')
+    for count in (5, 50, 500):
+        matcher = ReactionGroupMatcher()
+        for group in make_groups(count):
+            matcher.add_group(*group)
+        matcher.compile()
+        for emoji in EMOJI:
+            assert matcher.match(emoji) == every_group(matcher, emoji), emoji
+        stream = [random.choice(EMOJI) for _ in range(args.events)]
+        before = per_event(lambda emoji: every_group(matcher, emoji), stream)
+        uncached = per_event(matcher._match, stream)
+        memoized = per_event(matcher.match, stream)
+        print(f'{count:>6} {before:>9.2f} us {uncached:>7.2f} us {memoized:>7.2f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Latency of the reaction log queries with and without the indexes from db._index_reactions and
+db._index_failed_removals, on a generated reactions table (10M rows by default). The table is kept between runs.
+
+    python bench/reaction_queries.py [--rows 10000000] [--db bench_reactions.db]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import _index_failed_removals, _index_reactions, migrate
+
+CHANNEL_ID = 42
+GUILD_ID = 7
+EMOJI = ['👍', '😂', '🇯🇵', '<:neuroPog:123456789012345678>', '❤️', '🔥', '<a:dance:987654321098765432>', '😭']
+
+# The queries on_raw_reaction_remove, reaction counting and /reactions first run
+QUERIES = {
+    'remove lookup': '''
+        SELECT rowid
+        FROM reactions
+        WHERE message_id = ? AND channel_id = ? AND guild_id = ? AND user_id = ? AND emoji = ? AND removed IN (0, 3)
+    ''',
+    'reaction count': '''
+        SELECT COUNT(*), SUM(removed IN (0, 3))
+        FROM reactions
+        WHERE message_id = ? AND channel_id = ? AND guild_id = ? AND emoji = ?
+    ''',
+    'first reactions': '''
+        SELECT emoji, user_id, GROUP_CONCAT(time), MIN(channel_id)
+        FROM reactions
+        WHERE message_id = ? AND guild_id = ? AND nth = 1
+        GROUP BY emoji, user_id ORDER BY MIN(time) ASC
+    ''',
+}
+
+
+def generate(con: sqlite3.Connection, rows: int):
+    """
+    Fills the reactions table with messages of 5 to 200 reactions, and the odd hot message with 20,000.
+    """
+    def reactions():
+        random.seed(1)
+        message_id = 10 ** 17
+        n = 0
+        while n < rows:
+            message_id += random.randint(1, 10 ** 6)
+            counts = {}
+            for _ in range(random.choice((5, 20, 50, 200)) if random.random() < 0.98 else 20_000):
+                if n == rows:
+                    return
+                emoji = random.choice(EMOJI)
+                counts[emoji] = counts.get(emoji, 0) + 1
+                removed = 0 if random.random() < 0.8 else 1
+                yield (message_id, CHANNEL_ID, GUILD_ID, random.randint(1, 200_000), emoji, removed, counts[emoji], 1_700_000_000_000 + n, '')
+                n += 1
+
+    con.execute('PRAGMA journal_mode = OFF')
+    con.execute('PRAGMA synchronous = OFF')
+    con.execute('BEGIN')
+    con.executemany('''
+        INSERT OR IGNORE INTO reactions (message_id, channel_id, guild_id, user_id, emoji, removed, nth, time, hit_groups)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', reactions())
+    con.execute('COMMIT')
+
+
+def bench(con: sqlite3.Connection, label: str, hot_message_id: int, message_id: int, iterations: int = 200):
+    for (name, query) in QUERIES.items():
+        for (size, message) in (('hot', hot_message_id), ('typical', message_id)):
+            if name == 'first reactions':
+                params = (message, GUILD_ID)
+            elif name == 'reaction count':
+                params = (message, CHANNEL_ID, GUILD_ID, '👍')
+            else:
+                params = (message, CHANNEL_ID, GUILD_ID, 5, '👍')
+            con.execute(query, params).fetchall()
+            start = time.perf_counter()
+            for _ in range(iterations):
+                con.execute(query, params).fetchall()
+            print(f'{label:8} {name:16} {size:8} {(time.perf_counter() - start) / iterations * 1000:9.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--db', default='bench_reactions.db')
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.db)
+    con.isolation_level = None
+    migrate(con)
+    existing = con.execute('SELECT COUNT(*) FROM reactions').fetchone()[0]
+    if existing != args.rows:
+        print(f'Generating {args.rows:,} reactions in {args.db}')
+        con.execute('DELETE FROM reactions')
+        generate(con, args.rows)
+
+    (hot_message_id,) = con.execute('''
+        SELECT message_id
+        FROM reactions
+        GROUP BY message_id
+        ORDER BY COUNT(*) DESC
+        LIMIT 1
+    ''').fetchone()
+    # The message with the median number of reactions
+    (message_id,) = con.execute('''
+        SELECT message_id
+        FROM reactions
+        GROUP BY message_id
+        ORDER BY COUNT(*)
+        LIMIT 1 OFFSET (SELECT COUNT(DISTINCT message_id) FROM reactions) / 2
+    ''').fetchone()
+
+    con.execute('DROP INDEX IF EXISTS reactions_active')
+    con.execute('DROP INDEX IF EXISTS reactions_first')
+    bench(con, 'before', hot_message_id, message_id)
+    start = time.perf_counter()
+    _index_reactions(con.cursor())
+    _index_failed_removals(con.cursor())
+    print(f'Building the indexes took {time.perf_counter() - start:.1f}s')
+    bench(con, 'after', hot_message_id, message_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,65 +1,716 @@
-import json
+import asyncio
+import bisect
+import hashlib
 import re
 import sqlite3
-from typing import Any
+import time
+import unicodedata
 
 import disnake
 from disnake.ext import commands
 from loguru import logger
-import requests
 
-from main import config
+from main import command_guild_ids, config, router
 from cog import Cog
-from utils import get_guild_config
+from db import migrate
+from deepl import DeepL, DeepLError
+from utils import LRUCache, get_guild_config
+
+deepl = DeepL(
+    config['jp']['deepl_api_key'],
+    config['jp'].get('deepl_api_url', 'https://api-free.deepl.com'),
+    timeout=config['jp'].get('deepl_timeout', 10),
+    max_requests=config['jp'].get('deepl_max_requests', 4))
+# Tasks closing the DeepL session on unload; the event loop only keeps weak references to them
+close_tasks = set()
+
+# Texts are collected for up to batch_window_ms, or until a batch limit is hit, and translated in one request
+batch_window_ms = config['jp'].get('batch_window_ms', 100)
+# DeepL accepts at most 50 texts and 128 KiB per request
+batch_max_texts = min(config['jp'].get('batch_max_texts', 50), 50)
+batch_max_bytes = config['jp'].get('batch_max_bytes', 64 * 1024)
+
+# Edits are re-translated once a message has gone this long without another edit
+edit_debounce_ms = config['jp'].get('edit_debounce_ms', 2000)
+
+# Failed translations are retried with exponential backoff between these bounds, until they're this old
+outbox_min_delay = config['jp'].get('outbox_min_delay', 5)
+outbox_max_delay = config['jp'].get('outbox_max_delay', 900)
+outbox_max_age_hours = config['jp'].get('outbox_max_age_hours', 24)
+# Seconds to stop sending to DeepL after it rate limits us (429) or the quota runs out (456)
+rate_limit_pause = config['jp'].get('rate_limit_pause', 60)
+quota_pause = config['jp'].get('quota_pause', 3600)
+
+# Filters a message must pass to be translated, in order; see TranslationFilter
+translation_filters = config['jp'].get('filters', ['empty', 'japanese'])
+# Kana/kanji a message needs, and their minimum share of its letters, to pass the japanese filter
+min_japanese_chars = config['jp'].get('min_japanese_chars', 1)
+min_japanese_ratio = config['jp'].get('min_japanese_ratio', 0.0)
+
+# Translations kept in memory, in the database, and how long before they're translated again
+cache_size = config['jp'].get('cache_size', 1000)
+cache_max_rows = config['jp'].get('cache_max_rows', 100_000)
+cache_ttl_days = config['jp'].get('cache_ttl_days', 30)
+
+# Seconds between checks of the DeepL quota, which also write the usage stats to the database
+usage_poll_interval = config['jp'].get('usage_poll_interval', 600)
+# Once fewer characters than this are left in the quota, only cached translations are served
+cache_only_threshold = config['jp'].get('cache_only_threshold', 10_000)
+
+
+def normalize(text: str) -> str:
+    """
+    Returns the text NFKC-normalized with whitespace collapsed, so trivially different texts compare equal.
+    """
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(normalize(text).encode()).hexdigest()
+
+
+class TranslationFilter:
+    """
+    Decides whether a message is worth translating, counting the messages each filter drops.
+    Custom emoji, mentions, timestamps, URLs and emoji are stripped before any filter runs.
+
+    Filters:
+    - empty: drops messages with no words left, e.g. only emoji, URLs or mentions
+    - japanese: drops messages without enough kana/kanji
+    """
+    TOKENS = re.compile(r'<a?:\w+:\d+>|<(?:@[!&]?|#)\d+>|<t:-?\d+(?::\w)?>|https?://\S+')
+    EMOJI = re.compile('[\U0001F000-\U0001FAFF\u2600-\u27BF\uFE0F\u200D]')
+    WORD = re.compile(r'\w')
+    LETTERS = re.compile(r'[^\W\d_]')
+    # Hiragana, katakana (including half-width) and CJK ideographs
+    JAPANESE = re.compile('[\u3040-\u30FF\u31F0-\u31FF\u3400-\u4DBF\u4E00-\u9FFF\uF900-\uFAFF\uFF66-\uFF9F]')
+
+    def __init__(self, filters: list[str]):
+        for name in filters:
+            if not hasattr(self, f'_filter_{name}'):
+                raise ValueError(f'Invalid translation filter: {name}')
+        self.filters = [(name, getattr(self, f'_filter_{name}')) for name in filters]
+        self.dropped = {name: 0 for name in filters}
+        self.passed = 0
+
+    def check(self, text: str) -> bool:
+        text = self.EMOJI.sub('', self.TOKENS.sub(' ', text))
+        for (name, keep) in self.filters:
+            if not keep(text):
+                self.dropped[name] += 1
+                return False
+        self.passed += 1
+        return True
+
+    def _filter_empty(self, text: str) -> bool:
+        return self.WORD.search(text) is not None
+
+    def _filter_japanese(self, text: str) -> bool:
+        # Only count kana/kanji that are letters, so punctuation like ・ can't make a message Japanese
+        # (and every counted character is also one of LETTERS)
+        japanese = sum(1 for char in self.JAPANESE.findall(text) if char.isalpha())
+        if japanese == 0 or japanese < min_japanese_chars:
+            return False
+        if min_japanese_ratio <= 0:
+            return True
+        return japanese / len(self.LETTERS.findall(text)) >= min_japanese_ratio
+
+
+def today() -> str:
+    return time.strftime('%Y-%m-%d', time.gmtime())
+
+
+class TranslationStats:
+    """
+    DeepL usage per guild and day, counted in memory and added to the jp_stats and jp_latency tables on flush().
+    """
+    COUNTERS = ('requests', 'texts', 'characters', 'deduplicated', 'cache_hits', 'cached_characters', 'errors', 'skipped')
+    # Upper bounds of the latency histogram buckets in milliseconds; the last one also holds anything slower
+    LATENCY_BUCKETS = (25, 50, 100, 150, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000, 30000)
+
+    def __init__(self, con: sqlite3.Connection):
+        self.con = con
+        # (guild_id, day) -> {counter: count}
+        self.counts = {}
+        # (guild_id, day, bucket_ms) -> count
+        self.latencies = {}
+        # Latest /v2/usage response
+        self.character_count = None
+        self.character_limit = None
+        self.usage_checked_at = None
+
+    def record(self, guild_id: int, **counts: int):
+        day_counts = self.counts.setdefault((guild_id, today()), dict.fromkeys(self.COUNTERS, 0))
+        for (name, count) in counts.items():
+            day_counts[name] += count
+
+    def record_latency(self, guild_id: int, seconds: float):
+        i = bisect.bisect_left(self.LATENCY_BUCKETS, seconds * 1000)
+        key = (guild_id, today(), self.LATENCY_BUCKETS[min(i, len(self.LATENCY_BUCKETS) - 1)])
+        self.latencies[key] = self.latencies.get(key, 0) + 1
+
+    def remaining(self) -> int | None:
+        if self.character_limit is None:
+            return None
+        return max(self.character_limit - self.character_count, 0)
+
+    def flush(self):
+        counts = self.counts
+        latencies = self.latencies
+        self.counts = {}
+        self.latencies = {}
+        if len(counts) == 0 and len(latencies) == 0:
+            return
+        columns = ', '.join(self.COUNTERS)
+        updates = ', '.join(f'{name} = {name} + excluded.{name}' for name in self.COUNTERS)
+        cur = self.con.cursor()
+        cur.execute('BEGIN')
+        cur.executemany(f'''
+            INSERT INTO jp_stats (guild_id, day, {columns})
+            VALUES (?, ?{', ?' * len(self.COUNTERS)})
+            ON CONFLICT (guild_id, day) DO UPDATE SET {updates}
+        ''', [(*key, *day_counts.values()) for (key, day_counts) in counts.items()])
+        cur.executemany('''
+            INSERT INTO jp_latency (guild_id, day, bucket_ms, count)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (guild_id, day, bucket_ms) DO UPDATE SET count = count + excluded.count
+        ''', [(*key, count) for (key, count) in latencies.items()])
+        cur.execute('COMMIT')
+        cur.close()
 
-deepl_api_key = config['jp']['deepl_api_key']
+    def summary(self, guild_id: int, since: str) -> tuple[dict[str, int], list[tuple[str, int]], dict[int, int]]:
+        """
+        Returns a guild's counter totals since the given day, characters sent per day,
+        and the 50th/90th/99th latency percentiles in milliseconds.
+        """
+        self.flush()
+        cur = self.con.cursor()
+        cur.execute(f'''
+            SELECT {', '.join(f'COALESCE(SUM({name}), 0)' for name in self.COUNTERS)}
+            FROM jp_stats
+            WHERE guild_id = ? AND day >= ?
+        ''', (guild_id, since))
+        totals = dict(zip(self.COUNTERS, cur.fetchone()))
+        cur.execute('''
+            SELECT day, characters
+            FROM jp_stats
+            WHERE guild_id = ? AND day >= ?
+            ORDER BY day
+        ''', (guild_id, since))
+        days = cur.fetchall()
+        cur.execute('''
+            SELECT bucket_ms, SUM(count)
+            FROM jp_latency
+            WHERE guild_id = ? AND day >= ?
+            GROUP BY bucket_ms
+            ORDER BY bucket_ms
+        ''', (guild_id, since))
+        buckets = cur.fetchall()
+        cur.close()
 
+        percentiles = {}
+        total = sum(count for (_, count) in buckets)
+        for p in (50, 90, 99):
+            seen = 0
+            for (bucket_ms, count) in buckets:
+                seen += count
+                if seen >= total * p / 100:
+                    percentiles[p] = bucket_ms
+                    break
+        return (totals, days, percentiles)
+
+
+class TranslationBatcher:
+    """
+    Collects texts for a short window and translates them with a single DeepL request.
+    """
+    def __init__(self, stats: TranslationStats):
+        self.stats = stats
+        # (text, guild ID, future for its translation) in arrival order
+        self.pending = []
+        self.pending_bytes = 0
+        self.flush_handle = None
+        self.requests = 0
+        self.texts = 0
+        # Batches being translated
+        self.send_tasks = set()
+
+    async def translate(self, text: str, guild_id: int) -> str:
+        """
+        Returns the translation once the batch containing the text has been translated.
+        Raises DeepLError if the batch failed.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((text, guild_id, future))
+        self.pending_bytes += len(text.encode())
+        if len(self.pending) >= batch_max_texts or self.pending_bytes >= batch_max_bytes:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(batch_window_ms / 1000, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if len(self.pending) == 0:
+            return
+        batch = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        task = asyncio.create_task(self._send(batch))
+        self.send_tasks.add(task)
+        task.add_done_callback(self.send_tasks.discard)
+
+    async def _send(self, batch: list[tuple[str, int, asyncio.Future]]):
+        # Identical texts in one batch are only sent once, counted against the guild that sent it first
+        texts = {}
+        for (text, guild_id, _) in batch:
+            if text in texts:
+                self.stats.record(guild_id, texts=1, deduplicated=1)
+            else:
+                texts[text] = guild_id
+                self.stats.record(guild_id, texts=1, characters=len(text))
+        guild_ids = set(texts.values())
+        for guild_id in guild_ids:
+            self.stats.record(guild_id, requests=1)
+        self.requests += 1
+        self.texts += len(batch)
+
+        start = time.monotonic()
+        try:
+            try:
+                results = await deepl.translate(list(texts))
+                if len(results) != len(texts):
+                    raise DeepLError(None, f'DeepL returned {len(results)} translations for {len(texts)} texts')
+            except Exception as e:
+                # Callers only expect DeepLError, e.g. from a malformed response
+                error = e if isinstance(e, DeepLError) else DeepLError(None, f'DeepL translation failed: {e!r}')
+                for guild_id in guild_ids:
+                    self.stats.record(guild_id, errors=1)
+                for (_, _, future) in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                return
+            for guild_id in guild_ids:
+                self.stats.record_latency(guild_id, time.monotonic() - start)
+            translations = dict(zip(texts, results))
+            for (text, _, future) in batch:
+                if not future.done():
+                    future.set_result(translations[text])
+        finally:
+            # Nothing may be left waiting on a batch that's done, e.g. if the send was cancelled
+            for (_, _, future) in batch:
+                if not future.done():
+                    future.cancel()
+
+
+class TranslationCache:
+    """
+    Translations keyed by normalized source text, in an in-memory LRU backed by the
+    jp_translation_cache table.
+    """
+    # Pruning the table runs once every this many new entries
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, con: sqlite3.Connection, target_lang: str = 'EN-US'):
+        self.con = con
+        self.target_lang = target_lang
+        # key -> (translation, created_at)
+        self.memory = LRUCache(cache_size)
+        self.memory_hits = 0
+        self.database_hits = 0
+        self.misses = 0
+        self.puts = 0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f'{self.target_lang}\0{normalize(text)}'.encode()).hexdigest()
+
+    def get(self, text: str) -> str | None:
+        key = self.key(text)
+        expired_before = time.time() - cache_ttl_days * 86400
+        entry = self.memory.get(key)
+        if entry is not None and entry[1] >= expired_before:
+            self.memory_hits += 1
+            return entry[0]
+        cur = self.con.cursor()
+        cur.execute('''
+            SELECT translation, created_at
+            FROM jp_translation_cache
+            WHERE key = ? AND created_at >= ?
+        ''', (key, expired_before))
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            self.misses += 1
+            return None
+        self.database_hits += 1
+        self.memory[key] = row
+        return row[0]
+
+    def put(self, text: str, translation: str):
+        key = self.key(text)
+        now = int(time.time())
+        self.memory[key] = (translation, now)
+        self.con.execute('''
+            INSERT OR REPLACE INTO jp_translation_cache (key, translation, created_at)
+            VALUES (?, ?, ?)
+        ''', (key, translation, now))
+        self.puts += 1
+        if self.puts % self.PRUNE_INTERVAL == 0:
+            self.prune()
+
+    def prune(self):
+        """
+        Drops expired entries, then the oldest entries past cache_max_rows.
+        """
+        self.con.execute('''
+            DELETE FROM jp_translation_cache
+            WHERE created_at < ?
+        ''', (time.time() - cache_ttl_days * 86400,))
+        self.con.execute('''
+            DELETE FROM jp_translation_cache
+            WHERE rowid IN (
+                SELECT rowid
+                FROM jp_translation_cache
+                ORDER BY created_at DESC
+                LIMIT -1 OFFSET ?
+            )
+        ''', (cache_max_rows,))
+
+
+class TranslationOutbox:
+    """
+    Messages whose translation failed, kept in the jp_outbox table and retried in order
+    with exponential backoff by a background task.
+    While DeepL is unreachable, rate limiting or out of quota the whole outbox waits, so translations still
+    go out in order; a message that fails on its own only backs off itself, and one that can never succeed is dropped.
+    """
+    def __init__(self, cog: 'JP'):
+        self.cog = cog
+        self.con = cog.con
+        # Nothing is sent to DeepL before this time, after a 429 or 456, or while it can't be reached
+        self.paused_until = 0
+        self.size = self.con.execute('SELECT COUNT(*) FROM jp_outbox').fetchone()[0]
+        self.wakeup = asyncio.Event()
+
+    def active(self) -> bool:
+        """
+        Returns whether new messages should queue behind the outbox rather than be translated directly.
+        """
+        return self.size > 0 or time.time() < self.paused_until
+
+    def add(self, message: disnake.Message, error: DeepLError = None):
+        now = int(time.time())
+        cur = self.con.cursor()
+        cur.execute('''
+            INSERT OR IGNORE INTO jp_outbox (message_id, channel_id, guild_id, next_attempt, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (message.id, message.channel.id, message.guild.id, now, now))
+        self.size += cur.rowcount
+        cur.close()
+        if error is not None:
+            self.pause_for(error)
+        self.wakeup.set()
+
+    def pause_for(self, error: DeepLError):
+        if error.status == 429:
+            pause = rate_limit_pause
+        elif error.status == 456:
+            pause = quota_pause
+        else:
+            return
+        self._pause(pause, f'status code {error.status}')
 
-class JP(Cog):
-    con = sqlite3.connect('neurobot.db')
-    con.isolation_level = None
+    def _pause(self, pause: float, reason: str):
+        if time.time() + pause > self.paused_until:
+            logger.warning(f'Pausing DeepL requests for {pause:.0f}s after {reason}')
+            self.paused_until = time.time() + pause
 
-    def __init__(self, bot: commands.Bot):
-        super().__init__(bot)
-        # TABLE: jp_translations
+    @staticmethod
+    def retryable(error: DeepLError | disnake.HTTPException) -> bool:
+        """
+        Returns whether the request could succeed later; other errors, e.g. a 400 or 403, never will.
+        """
+        return error.status is None or error.status in (429, 456) or error.status >= 500
+
+    def _remove(self, message_id: int):
         cur = self.con.cursor()
         cur.execute('''
-            CREATE TABLE IF NOT EXISTS jp_translations (
-                message_id INTEGER NOT NULL,
-                translated_message_id INTEGER,
-                PRIMARY KEY (message_id)
-            )
-        ''')
+            DELETE FROM jp_outbox
+            WHERE message_id = ?
+        ''', (message_id,))
+        self.size -= cur.rowcount
         cur.close()
 
-    @commands.Cog.listener()
-    async def on_message(self, message: disnake.Message):
-        if message.author.bot:
+    async def run(self):
+        await self.cog.bot.wait_until_ready()
+        while True:
+            try:
+                await self._run_once()
+            except Exception:
+                # The outbox must keep draining, or every new message would queue behind it for good
+                logger.exception('Translation outbox failed')
+                await asyncio.sleep(outbox_min_delay)
+
+    async def _run_once(self):
+        delay = self.paused_until - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
             return
-
-        if message.guild is None:
+        # The first message that's due, so one backing off doesn't hold up the rest
+        row = self.con.execute('''
+            SELECT message_id, channel_id, guild_id, attempts, created_at
+            FROM jp_outbox
+            WHERE next_attempt <= ?
+            ORDER BY message_id
+            LIMIT 1
+        ''', (time.time(),)).fetchone()
+        if row is None:
+            (next_attempt,) = self.con.execute('SELECT MIN(next_attempt) FROM jp_outbox').fetchone()
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), next_attempt - time.time() if next_attempt is not None else None)
+            except asyncio.TimeoutError:
+                pass
             return
-
-        guild_config = get_guild_config(message.guild.id, 'jp')
-        if guild_config is None:
+        try:
+            await self._retry(*row)
+        except Exception:
+            logger.exception(f'Unexpected error retrying translation of message {row[0]}')
+            # Back off like any other failure, so the entry expires eventually
+            self._back_off(row[0], row[3])
+
+    async def _retry(self, message_id: int, channel_id: int, guild_id: int, attempts: int, created_at: int):
+        if time.time() - created_at > outbox_max_age_hours * 3600:
+            logger.error(f'Giving up translating message {message_id} after {attempts} attempts')
+            self._remove(message_id)
             return
 
-        target_channel_id = int(guild_config['target_channel'])
-        output_channel_id = int(guild_config['output_channel'])
+        guild_config = get_guild_config(guild_id, 'jp')
+        channel = self.cog.bot.get_channel(channel_id)
+        if guild_config is None or channel is None:
+            self._remove(message_id)
+            return
+        try:
+            message = await channel.fetch_message(message_id)
+        except disnake.NotFound:
+            # Deleted while waiting; nothing to translate
+            self._remove(message_id)
+            return
+        except disnake.HTTPException as e:
+            self._failed(message_id, attempts, f'Could not fetch message {message_id} to translate: {e}', self.retryable(e))
+            return
 
-        if message.channel.id != target_channel_id:
+        try:
+            translated = await self.cog.get_translation(message.content, guild_id)
+        except DeepLError as e:
+            self.pause_for(e)
+            retryable = self.retryable(e)
+            self._failed(message_id, attempts, f'Retrying translation of message {message_id} failed: {e}', retryable)
+            if retryable:
+                # DeepL itself is failing, so later messages would too; hold them all back in order
+                self._pause(self._backoff(attempts + 1), 'a failed translation')
+            return
+        if translated is None:
+            logger.info(f'Not translating message {message_id} while only serving cached translations')
+            self._remove(message_id)
             return
 
-        # ignore messages that are only emojis
-        if re.match(r'^<a?:\w+:\d+>$', message.content):
+        try:
+            await self.cog.send_translation(message, translated, int(guild_config['output_channel']))
+        except disnake.HTTPException as e:
+            self._failed(message_id, attempts, f'Could not send translation of message {message_id}: {e}', self.retryable(e))
             return
+        self._remove(message_id)
 
-        # ignore messages that are only URLs
-        if re.match(r'^https?://\S+$', message.content):
+    @staticmethod
+    def _backoff(attempts: int) -> float:
+        return min(outbox_min_delay * 2 ** (attempts - 1), outbox_max_delay)
+
+    def _failed(self, message_id: int, attempts: int, error: str, retryable: bool):
+        if not retryable:
+            logger.error(f'{error}; dropping it from the outbox')
+            self._remove(message_id)
             return
+        logger.error(error)
+        self._back_off(message_id, attempts)
+
+    def _back_off(self, message_id: int, attempts: int):
+        attempts += 1
+        self.con.execute('''
+            UPDATE jp_outbox
+            SET attempts = ?, next_attempt = ?
+            WHERE message_id = ?
+        ''', (attempts, int(time.time() + self._backoff(attempts)), message_id))
 
-        # ignore messages that are only mentions
-        if re.match(r'^<@!?\d+>$', message.content):
+
+class JP(Cog):
+    con = sqlite3.connect('neurobot.db')
+    con.isolation_level = None
+
+    def __init__(self, bot: commands.Bot):
+        super().__init__(bot)
+        migrate(self.con)
+        self.translation_cache = TranslationCache(self.con)
+        self.translation_filter = TranslationFilter(translation_filters)
+        self.translation_stats = TranslationStats(self.con)
+        self.batcher = TranslationBatcher(self.translation_stats)
+        # Set while the DeepL quota is nearly used up; only cached translations are served
+        self.cache_only = False
+        self.usage_task = None
+        for guild_id in command_guild_ids:
+            guild_config = get_guild_config(guild_id, 'jp')
+            if guild_config is not None:
+                router.register(guild_id, int(guild_config['target_channel']), self.handle_message)
+        # message ID -> task re-translating it once its edits settle
+        self.pending_edits = {}
+        self.outbox = TranslationOutbox(self)
+        self.outbox_task = None
+
+    async def cog_load(self):
+        self.outbox_task = asyncio.create_task(self.outbox.run())
+        self.usage_task = asyncio.create_task(self.poll_usage())
+
+    def cog_unload(self):
+        super().cog_unload()
+        router.unregister(self.handle_message)
+        for task in self.pending_edits.values():
+            task.cancel()
+        for task in (self.outbox_task, self.usage_task):
+            if task is not None:
+                task.cancel()
+        self.translation_stats.flush()
+        task = asyncio.create_task(deepl.close())
+        close_tasks.add(task)
+        task.add_done_callback(close_tasks.discard)
+
+    async def poll_usage(self):
+        while True:
+            try:
+                await self.check_usage()
+            except DeepLError as e:
+                logger.error(f'Could not check DeepL usage: {e}')
+            except Exception:
+                logger.exception('Could not check DeepL usage')
+            try:
+                self.translation_stats.flush()
+            except Exception:
+                logger.exception('Could not write translation stats')
+            await asyncio.sleep(usage_poll_interval)
+
+    async def check_usage(self):
+        """
+        Fetches the DeepL quota, switching to serving only cached translations when it's nearly used up.
+        """
+        (self.translation_stats.character_count, self.translation_stats.character_limit) = await deepl.usage()
+        self.translation_stats.usage_checked_at = int(time.time())
+        remaining = self.translation_stats.remaining()
+        cache_only = remaining < cache_only_threshold
+        if cache_only and not self.cache_only:
+            logger.warning(f'{remaining} DeepL characters left; only serving cached translations')
+        elif self.cache_only and not cache_only:
+            logger.info(f'{remaining} DeepL characters left; translating again')
+        self.cache_only = cache_only
+
+    async def get_translation(self, text: str, guild_id: int) -> str | None:
+        """
+        Returns the translation from the cache, or translates and caches it.
+        Returns None if it isn't cached and only cached translations are being served.
+        Raises DeepLError if DeepL fails.
+        """
+        translated = self.translation_cache.get(text)
+        if translated is not None:
+            self.translation_stats.record(guild_id, cache_hits=1, cached_characters=len(text))
+            return translated
+        if self.cache_only:
+            self.translation_stats.record(guild_id, skipped=1)
+            return None
+        translated = await self.batcher.translate(text, guild_id)
+        self.translation_cache.put(text, translated)
+        return translated
+
+    @commands.slash_command(invoke_without_command=False, guild_ids=command_guild_ids)
+    async def jp(self, ctx: disnake.ApplicationCommandInteraction):
+        pass
+
+    @jp.sub_command()
+    @commands.has_permissions(manage_messages=True)
+    async def cache(self, ctx: disnake.ApplicationCommandInteraction):
+        """
+        View translation cache hits and misses
+        """
+        hits = self.translation_cache.memory_hits + self.translation_cache.database_hits
+        lookups = hits + self.translation_cache.misses
+        hit_rate = f'{hits / lookups:.1%}' if lookups > 0 else 'n/a'
+        await ctx.send(f'Translation cache: {hits} hits ({self.translation_cache.memory_hits} memory, {self.translation_cache.database_hits} database), '
+                       f'{self.translation_cache.misses} misses, {hit_rate} hit rate; {len(self.translation_cache.memory)} entries in memory', ephemeral=True)
+
+    @jp.sub_command()
+    @commands.has_permissions(manage_messages=True)
+    async def filters(self, ctx: disnake.ApplicationCommandInteraction):
+        """
+        View how many messages each translation filter dropped
+        """
+        dropped = ', '.join(f'{name}: {count}' for (name, count) in self.translation_filter.dropped.items())
+        await ctx.send(f'Translation filters: {self.translation_filter.passed} passed; dropped {dropped or "none"}', ephemeral=True)
+
+    @jp.sub_command()
+    @commands.has_permissions(manage_messages=True)
+    async def stats(self,
+                    ctx: disnake.ApplicationCommandInteraction,
+                    days: int = commands.Param(
+                        7,
+                        name='days',
+                        description='How many days back to report, including today',
+                        ge=1,
+                        le=90)):
+        """
+        View DeepL quota, latency and savings for this server
+        """
+        if self.translation_stats.usage_checked_at is None:
+            quota = 'Not checked yet'
+        else:
+            quota = (f'{self.translation_stats.character_count:,} / {self.translation_stats.character_limit:,} characters used, '
+                     f'{self.translation_stats.remaining():,} left (checked <t:{self.translation_stats.usage_checked_at}:R>)')
+        if self.cache_only:
+            quota += f'\n**Only serving cached translations** until at least {cache_only_threshold:,} characters are left'
+
+        since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (days - 1) * 86400))
+        (totals, per_day, percentiles) = self.translation_stats.summary(ctx.guild.id, since)
+
+        embed = disnake.Embed(
+            title=f'DeepL usage, last {days} day{"s" if days != 1 else ""}',
+            color=0xAA8ED6
+        )
+        embed.add_field(name='Quota (all servers)', value=quota, inline=False)
+        embed.add_field(name='Sent', value=f'{totals["characters"]:,} characters\n'
+                                           f'{totals["texts"]:,} texts in {totals["requests"]:,} requests\n'
+                                           f'{totals["errors"]:,} failed requests')
+        embed.add_field(name='Saved', value=f'{totals["cached_characters"]:,} characters from {totals["cache_hits"]:,} cache hits\n'
+                                            f'{totals["texts"] - totals["requests"]:,} requests by batching\n'
+                                            f'{totals["deduplicated"]:,} duplicate texts')
+        if len(percentiles) > 0:
+            latency = ', '.join(f'p{p} ≤ {ms:,} ms' for (p, ms) in percentiles.items())
+        else:
+            latency = 'No requests'
+        embed.add_field(name='Latency', value=latency, inline=False)
+        if totals['skipped'] > 0:
+            embed.add_field(name='Not translated in cache-only mode', value=f'{totals["skipped"]:,} messages', inline=False)
+        if len(per_day) > 0:
+            # Only the most recent days fit in a field
+            embed.add_field(name='Characters per day', value='\n'.join(f'{day}: {characters:,}' for (day, characters) in per_day[-14:]), inline=False)
+
+        await ctx.send(embed=embed, ephemeral=True)
+
+    async def handle_message(self, message: disnake.Message):
+        """
+        Translates messages in the target channel, routed by the message router.
+        """
+        output_channel_id = int(get_guild_config(message.guild.id, 'jp')['output_channel'])
+
+        # ignore messages that are only emojis/URLs/mentions or aren't Japanese
+        if not self.translation_filter.check(message.content):
             return
 
         cur = self.con.cursor()
@@ -68,17 +719,43 @@ class JP(Cog):
             VALUES (?)
         ''', (message.id,))
 
-        translated = translate(message.content)
+        cur.close()
+
+        # Queue behind earlier failures, or while DeepL is paused, so translations go out in order
+        if self.outbox.active():
+            self.outbox.add(message)
+            return
+
+        try:
+            translated = await self.get_translation(message.content, message.guild.id)
+        except DeepLError as e:
+            logger.error(str(e))
+            if self.outbox.retryable(e):
+                self.outbox.add(message, e)
+            return
+
         if translated is None:
-            cur.close()
             return
 
+        await self.send_translation(message, translated, output_channel_id)
+
+    async def send_translation(self, message: disnake.Message, translated: str, output_channel_id: int):
+        embed = self._build_embed(message, translated)
+        translated_message = await self.bot.get_channel(output_channel_id).send(embed=embed)
+
+        self.con.execute('''
+            UPDATE jp_translations
+            SET translated_message_id = ?, content_hash = ?
+            WHERE message_id = ?
+        ''', (translated_message.id, content_hash(message.content), message.id))
+
+    def _build_embed(self, message: disnake.Message, translated: str, edit_count: int = 0) -> disnake.Embed:
         description = 'via DeepL | [Jump to message](' + message.jump_url + ')'
 
         embed = disnake.Embed(
             description=description,
             color=0xAA8ED6,
-            timestamp=message.created_at
+            timestamp=message.edited_at if edit_count > 0 else message.created_at
         )
 
         name = message.author.name + ('#' + message.author.discriminator if message.author.discriminator != '0' else '')
@@ -87,14 +764,9 @@ class JP(Cog):
         embed.add_field(name='', value=message.content)
         embed.add_field(name='Translation', value=translated, inline=False)
 
-        translated_message = await self.bot.get_channel(output_channel_id).send(embed=embed)
-
-        cur.execute('''
-            UPDATE jp_translations
-            SET translated_message_id = ?
-            WHERE message_id = ?
-        ''', (translated_message.id, message.id))
-        cur.close()
+        if edit_count > 0:
+            embed.set_footer(text=f'Edited {edit_count}x')
+        return embed
 
     @commands.Cog.listener()
     async def on_message_edit(self, before: disnake.Message, after: disnake.Message):
@@ -104,6 +776,10 @@ class JP(Cog):
         if before.guild is None:
             return
 
+        # embed unfurls and pins also fire edits
+        if before.content == after.content:
+            return
+
         guild_config = get_guild_config(before.guild.id, 'jp')
         if guild_config is None:
             return
@@ -114,59 +790,62 @@ class JP(Cog):
         if before.channel.id != target_channel_id:
             return
 
+        # Restart the wait on every edit so a burst of edits is translated once
+        pending = self.pending_edits.pop(after.id, None)
+        if pending is not None:
+            pending.cancel()
+        self.pending_edits[after.id] = asyncio.create_task(self._retranslate(after, output_channel_id))
+
+    async def _retranslate(self, message: disnake.Message, output_channel_id: int):
+        try:
+            await asyncio.sleep(edit_debounce_ms / 1000)
+            # Wait out a DeepL pause too; a newer edit still replaces this one in the meantime
+            while time.time() < self.outbox.paused_until:
+                await asyncio.sleep(self.outbox.paused_until - time.time())
+        finally:
+            if self.pending_edits.get(message.id) is asyncio.current_task():
+                del self.pending_edits[message.id]
+
         cur = self.con.cursor()
         cur.execute('''
-            SELECT translated_message_id FROM jp_translations
+            SELECT translated_message_id, content_hash, edit_count FROM jp_translations
             WHERE message_id = ?
-        ''', (before.id,))
+        ''', (message.id,))
         row = cur.fetchone()
         cur.close()
 
-        if row is None:
+        if row is None or row[0] is None:
             return
 
-        translated_message_id = row[0]
+        (translated_message_id, old_hash, edit_count) = row
+        new_hash = content_hash(message.content)
+        if new_hash == old_hash:
+            return
 
-        translated_message = await self.bot.get_channel(output_channel_id).fetch_message(translated_message_id)
-        if translated_message is None:
+        try:
+            translated = await self.get_translation(message.content, message.guild.id)
+        except DeepLError as e:
+            logger.error(str(e))
+            self.outbox.pause_for(e)
             return
 
-        translated = translate(after.content)
         if translated is None:
-            cur.close()
-            return
-
-        # update embed
-        embed = translated_message.embeds[0]
-        embed.timestamp = after.edited_at
-        embed.set_field_at(0, name='', value=after.content)
-        embed.set_field_at(1, name='Translation', value=translated, inline=False)
-        edit_count = 0
-        if embed.footer is not None:
-            edit_count = int(embed.footer.text.split(' ')[1].removesuffix('x'))
-        embed.set_footer(text=f'Edited {edit_count + 1}x')
-        await translated_message.edit(embed=embed)
-
-
-def translate(text) -> Any | None:
-    body = {
-        'source_lang': 'JA',
-        'target_lang': 'EN-US',
-        'text': [text]
-    }
-    body_enc = json.dumps(body)
-
-    r = requests.post('https://api-free.deepl.com/v2/translate', data=body_enc, headers={
-        'Authorization': 'DeepL-Auth-Key ' + deepl_api_key,
-        'Content-Type': 'application/json',
-        'Content-Length': str(len(body_enc))
-    })
-    if r.status_code != 200:
-        logger.error('Deepl returned status code {code}', code=r.status_code)
-        logger.error(r.text)
-        return
-
-    return r.json()['translations'][0]['text']
+            return
+
+        # Rebuild the embed rather than fetching the output message to update it
+        embed = self._build_embed(message, translated, edit_count + 1)
+        translated_message = self.bot.get_partial_messageable(output_channel_id).get_partial_message(translated_message_id)
+        try:
+            await translated_message.edit(embed=embed)
+        except disnake.NotFound:
+            logger.error(f'Could not find translation {translated_message_id} of message {message.id}')
+            return
+
+        self.con.execute('''
+            UPDATE jp_translations
+            SET content_hash = ?, edit_count = ?
+            WHERE message_id = ?
+        ''', (new_hash, edit_count + 1, message.id))
 
 
 def setup(bot: commands.Bot):
@@ -0,0 +1,112 @@
+import asyncio
+
+import disnake
+from disnake.ext import commands
+from loguru import logger
+
+from cog import Cog
+from member_index import MemberIndex, indexes
+
+
+class Members(Cog):
+    """
+    Keeps member_index.indexes up to date from the member cache and member and role events.
+    """
+    # Members indexed between yields to the event loop while building an index
+    BUILD_CHUNK = 2000
+
+    def __init__(self, bot: commands.Bot):
+        super().__init__(bot)
+        # guild ID -> index being built; events are applied to it too so it isn't stale once built
+        self.building = {}
+        self.build_tasks = set()
+
+    async def cog_load(self):
+        if self.bot.is_ready():
+            self._build_all()
+
+    def cog_unload(self):
+        super().cog_unload()
+        for task in self.build_tasks:
+            task.cancel()
+        indexes.clear()
+
+    def _build_all(self):
+        for guild in self.bot.guilds:
+            self._build(guild)
+
+    def _build(self, guild: disnake.Guild):
+        task = asyncio.create_task(self._build_index(guild))
+        self.build_tasks.add(task)
+        task.add_done_callback(self.build_tasks.discard)
+
+    async def _build_index(self, guild: disnake.Guild):
+        index = MemberIndex()
+        self.building[guild.id] = index
+        try:
+            members = list(guild.members)
+            for i in range(0, len(members), self.BUILD_CHUNK):
+                for member in members[i:i + self.BUILD_CHUNK]:
+                    # Members who left since the snapshot was taken were already handled by on_member_remove
+                    if guild.get_member(member.id) is not None:
+                        index.add(member)
+                await asyncio.sleep(0)
+        finally:
+            if self.building.get(guild.id) is index:
+                del self.building[guild.id]
+        indexes[guild.id] = index
+        logger.debug(f'Indexed {len(index)} members of {guild.name}')
+
+    def _indexes(self, guild_id: int) -> list[MemberIndex]:
+        return [index for index in (indexes.get(guild_id), self.building.get(guild_id)) if index is not None]
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Also fires after reconnecting, when the member cache may have changed wholesale
+        self._build_all()
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: disnake.Guild):
+        self._build(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: disnake.Guild):
+        indexes.pop(guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: disnake.Member):
+        for index in self._indexes(member.guild.id):
+            index.add(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: disnake.Member, after: disnake.Member):
+        # Name and role changes; the index skips whatever didn't change
+        for index in self._indexes(after.guild.id):
+            index.add(after)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: disnake.User, after: disnake.User):
+        # Username changes aren't member updates; reindex the user in every guild they're in
+        if before.name == after.name and before.global_name == after.global_name:
+            return
+        for guild in after.mutual_guilds:
+            member = guild.get_member(after.id)
+            if member is None:
+                continue
+            for index in self._indexes(guild.id):
+                index.add(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: disnake.Member):
+        for index in self._indexes(member.guild.id):
+            index.remove(member.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: disnake.Role):
+        # Members lose deleted roles without a member update
+        for index in self._indexes(role.guild.id):
+            index.remove_role(role.id)
+
+
+def setup(bot: commands.Bot):
+    bot.add_cog(Members(bot))
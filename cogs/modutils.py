@@ -1,15 +1,146 @@
-from typing import Callable
+import asyncio
+import heapq
+import io
+import re
+import sqlite3
+import time
 
 import disnake
 from disnake.ext import commands
 from loguru import logger
 
-from main import command_guild_ids
+from main import command_guild_ids, config
 from cog import Cog
-from utils import get_guild_config
+from db import migrate
+from member_index import member_choices, role_member_ids, search_members
+from utils import get_guild_config, parsetime, retry_rate_limited
+
+# Expired embed ban roles removed at once, and seconds before retrying one whose role couldn't be removed
+expiry_concurrency = config.get('modutils', {}).get('expiry_concurrency', 4)
+expiry_retry_delay = config.get('modutils', {}).get('expiry_retry_delay', 300)
+# Role edits in flight at once for /embedban bulkadd and bulkremove
+bulk_concurrency = config.get('modutils', {}).get('bulk_concurrency', 4)
+# Attempts at a role edit Discord still rate limits after disnake's own retries, and seconds between them
+rate_limit_attempts = config.get('modutils', {}).get('rate_limit_attempts', 3)
+rate_limit_pause = config.get('modutils', {}).get('rate_limit_pause', 10)
 
 
 class ModUtils(Cog):
+    con = sqlite3.connect('neurobot.db')
+    con.isolation_level = None
+
+    # Embed banned users listed per page of /embedban list
+    LIST_PAGE_SIZE = 25
+    # User IDs, bare or in mentions
+    USER_IDS = re.compile(r'\d{15,20}')
+
+    def __init__(self, bot: commands.Bot):
+        super().__init__(bot)
+        migrate(self.con)
+        # Min-heap of (expires_at, guild ID, user ID) for timed embed bans. Bans removed or reissued
+        # leave their entry behind; it's checked against embed_bans when it comes due.
+        self.expiries = []
+        self.expiries_changed = asyncio.Event()
+        self.expiry_task = None
+
+    async def cog_load(self):
+        cur = self.con.cursor()
+        cur.execute('''
+            SELECT expires_at, guild_id, user_id
+            FROM embed_bans
+            WHERE expires_at IS NOT NULL
+        ''')
+        self.expiries = cur.fetchall()
+        cur.close()
+        heapq.heapify(self.expiries)
+        self.expiry_task = asyncio.create_task(self._expire_embed_bans())
+
+    def cog_unload(self):
+        super().cog_unload()
+        if self.expiry_task is not None:
+            self.expiry_task.cancel()
+
+    def _record_ban(self, guild_id: int, user_id: int, banned_by: int, expires_at: int | None):
+        self.con.execute('''
+            INSERT OR REPLACE INTO embed_bans (guild_id, user_id, banned_by, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (guild_id, user_id, banned_by, int(time.time()), expires_at))
+        if expires_at is not None:
+            self._schedule_expiry(expires_at, guild_id, user_id)
+
+    def _delete_ban(self, guild_id: int, user_id: int):
+        # Any scheduled expiry is skipped once it finds the ban gone
+        self.con.execute('''
+            DELETE FROM embed_bans
+            WHERE guild_id = ? AND user_id = ?
+        ''', (guild_id, user_id))
+
+    def _schedule_expiry(self, expires_at: int, guild_id: int, user_id: int):
+        heapq.heappush(self.expiries, (expires_at, guild_id, user_id))
+        # Wake the scheduler if this is now the soonest expiry
+        if self.expiries[0] == (expires_at, guild_id, user_id):
+            self.expiries_changed.set()
+
+    async def _expire_embed_bans(self):
+        await self.bot.wait_until_ready()
+        while True:
+            self.expiries_changed.clear()
+            if len(self.expiries) == 0:
+                await self.expiries_changed.wait()
+                continue
+            delay = self.expiries[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.expiries_changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Everything due, including bans that expired while the bot was down, goes in one batch
+            due = []
+            while len(self.expiries) > 0 and self.expiries[0][0] <= time.time():
+                due.append(heapq.heappop(self.expiries))
+            removals = asyncio.Semaphore(expiry_concurrency)
+            await asyncio.gather(*(self._expire_embed_ban(removals, *entry) for entry in due))
+
+    async def _expire_embed_ban(self, removals: asyncio.Semaphore, expires_at: int, guild_id: int, user_id: int):
+        cur = self.con.cursor()
+        cur.execute('''
+            SELECT expires_at
+            FROM embed_bans
+            WHERE guild_id = ? AND user_id = ?
+        ''', (guild_id, user_id))
+        row = cur.fetchone()
+        cur.close()
+        # Removed or reissued since this entry was scheduled
+        if row is None or row[0] != expires_at:
+            return
+
+        guild_config = get_guild_config(guild_id, 'modutils')
+        guild = self.bot.get_guild(guild_id)
+        member = guild.get_member(user_id) if guild is not None else None
+        if guild_config is not None and member is not None:
+            role = guild.get_role(int(guild_config['embedban_role']))
+            if role is not None and role in member.roles:
+                try:
+                    async with removals:
+                        logger.debug(f'Removing expired embed ban role {role.id} from {member}')
+                        await member.remove_roles(role, reason='Embed ban expired')
+                except disnake.HTTPException as e:
+                    logger.error(f'Could not remove expired embed ban from {member}: {e}')
+                    retry_at = int(time.time()) + expiry_retry_delay
+                    self.con.execute('''
+                        UPDATE embed_bans
+                        SET expires_at = ?
+                        WHERE guild_id = ? AND user_id = ?
+                    ''', (retry_at, guild_id, user_id))
+                    self._schedule_expiry(retry_at, guild_id, user_id)
+                    return
+
+        self.con.execute('''
+            DELETE FROM embed_bans
+            WHERE guild_id = ? AND user_id = ?
+        ''', (guild_id, user_id))
+
     @commands.slash_command(invoke_without_commands=False, guild_ids=command_guild_ids)
     @commands.has_permissions(manage_messages=True)
     async def embedban(self, ctx: disnake.ApplicationCommandInteraction):
@@ -17,12 +148,15 @@ class ModUtils(Cog):
 
     @embedban.sub_command()
     @commands.has_permissions(manage_messages=True)
-    # @discord.option('duration', description='The duration to persist the embed ban')
     async def add(self,
                   ctx: disnake.ApplicationCommandInteraction,
                   user: str = commands.Param(
                       name='user',
-                      description='The name or ID of the user to embed ban')):
+                      description='The name or ID of the user to embed ban'),
+                  duration: str = commands.Param(
+                      None,
+                      name='duration',
+                      description='How long the embed ban lasts, like 30m, 12h or 1w2d; permanent if not given')):
         guild_config = get_guild_config(ctx.guild.id, 'modutils')
         if guild_config is None:
             await ctx.send('This guild does not have a configuration for this command.', ephemeral=True)
@@ -37,10 +171,7 @@ class ModUtils(Cog):
         elif user.startswith('<@') and user.endswith('>'):
             member = ctx.guild.get_member(int(user[2:-1]))
         else:
-            member_lambda: Callable[[disnake.Member], bool] = (lambda m:
-                                                               (user.lower() in m.name.lower()) or
-                                                               (user.lower() in m.display_name.lower()))
-            members = list(filter(member_lambda, ctx.guild.members))
+            members = search_members(ctx.guild, user, 1)
             if len(members) == 0:
                 await ctx.send('No users found by that name')
                 return
@@ -52,19 +183,22 @@ class ModUtils(Cog):
             await ctx.send(f'{member} is already embed banned; to update, remove and re-issue the embed ban')
             return
 
-        # TODO: Add duration support
-        #
-        # expiry_datetime = None
-        #
-        # if duration is not None:
-        #     duration_seconds = parsetime(duration)
-        #     now = datetime.now().timestamp()
-        #     expiry = now + duration_seconds
-        #     expiry_datetime = datetime.fromtimestamp(expiry)
+        expires_at = None
+        if duration is not None:
+            try:
+                expires_at = int(time.time()) + parsetime(duration)
+            except ValueError:
+                await ctx.send(f'Invalid duration `{duration}`; use e.g. 30m, 12h or 1w2d', ephemeral=True)
+                return
 
         logger.debug(f'Adding embed ban role {embedban_role_id} for {member}')
         await member.add_roles(role, reason=f'Embed banned by {ctx.author}')
-        await ctx.send(f'Embed ban issued for {member}')
+        self._record_ban(ctx.guild.id, member.id, ctx.author.id, expires_at)
+
+        if expires_at is None:
+            await ctx.send(f'Embed ban issued for {member}')
+        else:
+            await ctx.send(f'Embed ban issued for {member} until <t:{expires_at}:f> (<t:{expires_at}:R>)')
 
     @embedban.sub_command()
     @commands.has_permissions(manage_messages=True)
@@ -87,10 +221,7 @@ class ModUtils(Cog):
         elif user.startswith('<@') and user.endswith('>'):
             member = ctx.guild.get_member(int(user[2:-1]))
         else:
-            member_lambda: Callable[[disnake.Member], bool] = (lambda m:
-                                                               (user.lower() in m.name.lower()) or
-                                                               (user.lower() in m.display_name.lower()))
-            members = list(filter(member_lambda, ctx.guild.members))
+            members = search_members(ctx.guild, user, 1)
             if len(members) == 0:
                 await ctx.send('No users found by that name')
                 return
@@ -104,11 +235,146 @@ class ModUtils(Cog):
 
         logger.debug(f'Removing embed ban role {embedban_role_id} from {member}')
         await member.remove_roles(role, reason=f'Embed ban removed by {ctx.author}')
+        self._delete_ban(ctx.guild.id, member.id)
         await ctx.send(f'Embed ban removed from {member}')
 
+    @add.autocomplete('user')
+    @remove.autocomplete('user')
+    async def _user_autocomplete(self, ctx: disnake.ApplicationCommandInteraction, user: str):
+        return member_choices(ctx.guild, user)
+
     @embedban.sub_command()
     @commands.has_permissions(manage_messages=True)
-    async def list(self, ctx: disnake.ApplicationCommandInteraction):
+    async def bulkadd(self,
+                      ctx: disnake.ApplicationCommandInteraction,
+                      users: str = commands.Param(
+                          None,
+                          name='users',
+                          description='IDs or mentions of the users to embed ban, separated by anything'),
+                      joined_within: str = commands.Param(
+                          None,
+                          name='joined_within',
+                          description='Also embed ban everyone who joined this recently, like 10m or 1h'),
+                      duration: str = commands.Param(
+                          None,
+                          name='duration',
+                          description='How long the embed bans last, like 30m, 12h or 1w2d; permanent if not given')):
+        """
+        Embed ban many users at once
+        """
+        guild_config = get_guild_config(ctx.guild.id, 'modutils')
+        if guild_config is None:
+            await ctx.send('This guild does not have a configuration for this command.', ephemeral=True)
+            return
+
+        role = ctx.guild.get_role(int(guild_config['embedban_role']))
+
+        try:
+            expires_at = int(time.time()) + parsetime(duration) if duration is not None else None
+            joined_after = time.time() - parsetime(joined_within) if joined_within is not None else None
+        except ValueError as e:
+            await ctx.send(f'{e}; use e.g. 30m, 12h or 1w2d', ephemeral=True)
+            return
+
+        user_ids = self._parse_user_ids(users)
+        if joined_after is not None:
+            user_ids.update(member.id for member in ctx.guild.members
+                            if member.joined_at is not None and member.joined_at.timestamp() >= joined_after and not member.bot)
+        if len(user_ids) == 0:
+            await ctx.send('No users given', ephemeral=True)
+            return
+
+        await ctx.response.defer()
+
+        async def ban(member: disnake.Member) -> str | None:
+            if role in member.roles:
+                return 'already embed banned'
+            await member.add_roles(role, reason=f'Embed banned by {ctx.author} (bulk)')
+            self._record_ban(ctx.guild.id, member.id, ctx.author.id, expires_at)
+
+        results = await self._bulk_edit(ctx.guild, user_ids, ban)
+        title = f'Embed banned {sum(error is None for error in results.values())}/{len(results)} users'
+        if expires_at is not None:
+            title += f' until <t:{expires_at}:f>'
+        await self._send_bulk_summary(ctx, title, results)
+
+    @embedban.sub_command()
+    @commands.has_permissions(manage_messages=True)
+    async def bulkremove(self,
+                         ctx: disnake.ApplicationCommandInteraction,
+                         users: str = commands.Param(
+                             name='users',
+                             description='IDs or mentions of the users to remove embed bans from, separated by anything')):
+        """
+        Remove embed bans from many users at once
+        """
+        guild_config = get_guild_config(ctx.guild.id, 'modutils')
+        if guild_config is None:
+            await ctx.send('This guild does not have a configuration for this command.', ephemeral=True)
+            return
+
+        role = ctx.guild.get_role(int(guild_config['embedban_role']))
+
+        user_ids = self._parse_user_ids(users)
+        if len(user_ids) == 0:
+            await ctx.send('No users given', ephemeral=True)
+            return
+
+        await ctx.response.defer()
+
+        async def unban(member: disnake.Member) -> str | None:
+            if role not in member.roles:
+                return 'not embed banned'
+            await member.remove_roles(role, reason=f'Embed ban removed by {ctx.author} (bulk)')
+            self._delete_ban(ctx.guild.id, member.id)
+
+        results = await self._bulk_edit(ctx.guild, user_ids, unban)
+        await self._send_bulk_summary(ctx, f'Removed embed bans from {sum(error is None for error in results.values())}/{len(results)} users', results)
+
+    def _parse_user_ids(self, users: str | None) -> set[int]:
+        return {int(user_id) for user_id in self.USER_IDS.findall(users or '')}
+
+    async def _bulk_edit(self, guild: disnake.Guild, user_ids: set[int], edit) -> dict[int, str | None]:
+        """
+        Runs edit on each member with a few in flight at once, returning user ID -> the reason the edit
+        didn't happen, or None if it did.
+        """
+        edits = asyncio.Semaphore(bulk_concurrency)
+
+        async def run(user_id: int) -> str | None:
+            member = guild.get_member(user_id)
+            if member is None:
+                return 'not in the server'
+            async with edits:
+                try:
+                    return await retry_rate_limited(lambda: edit(member), rate_limit_attempts, rate_limit_pause, 'editing roles')
+                except disnake.HTTPException as e:
+                    logger.error(f'Could not edit roles of {member}: {e}')
+                    return f'failed ({e.status})'
+
+        user_ids = sorted(user_ids)
+        return dict(zip(user_ids, await asyncio.gather(*(run(user_id) for user_id in user_ids))))
+
+    async def _send_bulk_summary(self, ctx: disnake.ApplicationCommandInteraction, title: str, results: dict[int, str | None]):
+        lines = [f'✅ <@{user_id}> (`{user_id}`)' if error is None else f'❌ <@{user_id}> (`{user_id}`): {error}'
+                 for (user_id, error) in results.items()]
+        description = '\n'.join(lines)
+        if len(description) <= 4096:
+            await ctx.send(embed=disnake.Embed(title=title, description=description, color=0xAA8ED6))
+            return
+        # Too many users for an embed; attach the full list instead
+        summary = '\n'.join(f'{user_id}: {error or "ok"}' for (user_id, error) in results.items())
+        await ctx.send(title, file=disnake.File(io.BytesIO(summary.encode()), filename='embedbans.txt'))
+
+    @embedban.sub_command()
+    @commands.has_permissions(manage_messages=True)
+    async def list(self,
+                   ctx: disnake.ApplicationCommandInteraction,
+                   page: int = commands.Param(
+                       1,
+                       name='page',
+                       description='The page of embed banned users to show',
+                       ge=1)):
         guild_config = get_guild_config(ctx.guild.id, 'modutils')
         if guild_config is None:
             await ctx.send('This guild does not have a configuration for this command.', ephemeral=True)
@@ -117,12 +383,29 @@ class ModUtils(Cog):
         embedban_role_id = int(guild_config['embedban_role'])
         role = ctx.guild.get_role(embedban_role_id)
 
-        members = [member for member in ctx.guild.members if role in member.roles]
-        if len(members) == 0:
+        member_ids = role_member_ids(ctx.guild, role)
+        if len(member_ids) == 0:
             await ctx.send('No embed banned users')
             return
 
-        await ctx.send(f'Embed banned users: {", ".join([f"{member.mention} (`{member.id}`)" for member in members])}')
+        # Pages of mentions stay well under the message length limit
+        pages = (len(member_ids) - 1) // self.LIST_PAGE_SIZE + 1
+        page = min(page, pages)
+        start = (page - 1) * self.LIST_PAGE_SIZE
+        page_ids = member_ids[start:start + self.LIST_PAGE_SIZE]
+
+        cur = self.con.cursor()
+        cur.execute(f'''
+            SELECT user_id, expires_at
+            FROM embed_bans
+            WHERE guild_id = ? AND user_id IN ({",".join("?" * len(page_ids))}) AND expires_at IS NOT NULL
+        ''', (ctx.guild.id, *page_ids))
+        expiries = dict(cur.fetchall())
+        cur.close()
+
+        lines = '\n'.join(f'<@{member_id}> (`{member_id}`)' + (f' until <t:{expiries[member_id]}:f>' if member_id in expiries else '')
+                          for member_id in page_ids)
+        await ctx.send(f'Embed banned users ({len(member_ids)}), page {page}/{pages}:\n{lines}')
 
     @commands.message_command(name='Log Information', guild_ids=command_guild_ids)
     async def log_information(self, ctx: disnake.ApplicationCommandInteraction, message: disnake.Message):
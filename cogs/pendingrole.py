@@ -1,14 +1,99 @@
+import asyncio
+import sqlite3
+import time
+from collections import defaultdict
+
 import disnake
 from disnake.ext import commands
 from loguru import logger
 
-from main import command_guild_ids
+from main import command_guild_ids, config, router
 from cog import Cog
-from utils import get_guild_config
+from db import migrate
+from utils import get_guild_config, retry_rate_limited
+
+# Members are fetched and checkpointed in pages of this size, Discord's maximum
+manual_page_size = 1000
+# Role grants in flight at once during /pendingrole manual
+manual_workers = config.get('pendingrole', {}).get('manual_workers', 4)
+# Seconds between edits of the /pendingrole manual progress message
+manual_progress_interval = config.get('pendingrole', {}).get('manual_progress_interval', 10)
+# Attempts at a grant Discord still rate limits after disnake's own retries, and seconds between them
+manual_rate_limit_attempts = config.get('pendingrole', {}).get('manual_rate_limit_attempts', 5)
+manual_rate_limit_pause = config.get('pendingrole', {}).get('manual_rate_limit_pause', 30)
 
 
 class PendingRole(Cog):
-    manually_processing = []
+    con = sqlite3.connect('neurobot.db')
+    con.isolation_level = None
+
+    def __init__(self, bot: commands.Bot):
+        super().__init__(bot)
+        migrate(self.con)
+        # guild ID -> IDs of members known to have the roles, kept up to date by the member listeners
+        self.verified = defaultdict(set)
+        # (guild ID, member ID) -> task adding the roles; later triggers join it instead of sending another request
+        self.grants = {}
+        self.grants_deduplicated = 0
+        # guild ID -> task running /pendingrole manual
+        self.manual_runs = {}
+        self.resume_task = None
+        # Messages anywhere in the guild count as interaction
+        for guild_id in command_guild_ids:
+            guild_config = get_guild_config(guild_id, 'pendingrole')
+            if guild_config is not None and 'interaction' in guild_config['triggers']:
+                router.register(guild_id, None, self.handle_message)
+
+    async def cog_load(self):
+        self.resume_task = asyncio.create_task(self._resume_manual_runs())
+
+    def cog_unload(self):
+        super().cog_unload()
+        router.unregister(self.handle_message)
+        # Checkpoints stay in the database, so cancelled runs resume when the cog is loaded again
+        if self.resume_task is not None:
+            self.resume_task.cancel()
+        for task in self.manual_runs.values():
+            task.cancel()
+
+    def _has_roles(self, member: disnake.Member, role_ids: list[int]) -> bool:
+        """
+        Returns whether the member has any of the roles, remembering the answer for the listeners' fast path.
+        """
+        if any(role.id in role_ids for role in member.roles):
+            self.verified[member.guild.id].add(member.id)
+            return True
+        self.verified[member.guild.id].discard(member.id)
+        return False
+
+    async def _add_roles(self, member: disnake.Member, roles: list[disnake.Role], reason: str):
+        """
+        Adds the roles, or waits for the grant already in flight for the member.
+        """
+        key = (member.guild.id, member.id)
+        grant = self.grants.get(key)
+        if grant is None:
+            grant = asyncio.create_task(self._grant(member, roles, reason))
+            self.grants[key] = grant
+            grant.add_done_callback(lambda _: self.grants.pop(key, None))
+        else:
+            self.grants_deduplicated += 1
+        # Shielded so a cancelled caller doesn't cancel the grant for everyone else waiting on it
+        await asyncio.shield(grant)
+
+    async def _grant(self, member: disnake.Member, roles: list[disnake.Role], reason: str):
+        logger.debug(f'Adding roles {", ".join(str(role.id) for role in roles)} to {member.display_name}')
+        await member.add_roles(*roles, reason=reason)
+        self.verified[member.guild.id].add(member.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: disnake.Member):
+        # Rejoining members come back without their roles
+        self.verified[member.guild.id].discard(member.id)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: disnake.Member):
+        self.verified[member.guild.id].discard(member.id)
 
     @commands.Cog.listener()
     async def on_member_update(self, before: disnake.Member, after: disnake.Member):
@@ -17,31 +102,30 @@ class PendingRole(Cog):
             return
 
         role_ids = guild_config['roles']
-        roles = [after.guild.get_role(role_id) for role_id in role_ids]
 
         # if after has any of the roles in role_ids, skip
-        if any(role.id in role_ids for role in after.roles):
+        if self._has_roles(after, role_ids):
             return
 
         # if the user completed rule verification (no longer pending), add the roles
         if before.pending and not after.pending and 'rules' in guild_config['triggers']:
-            logger.debug(f'Adding roles {", ".join(str(x) for x in role_ids)} to {after.display_name}')
-            await after.add_roles(*roles, reason='[rules] User no longer pending rule verification')
-
-    @commands.Cog.listener()
-    async def on_message(self, message: disnake.Message):
-        if message.author.bot:
-            return
+            roles = [after.guild.get_role(role_id) for role_id in role_ids]
+            await self._add_roles(after, roles, '[rules] User no longer pending rule verification')
 
-        if message.guild is None:
+    async def handle_message(self, message: disnake.Message):
+        """
+        Grants the roles to authors of messages anywhere in the guild, routed by the message router.
+        """
+        # Nearly every author already has the roles
+        if message.author.id in self.verified[message.guild.id]:
             return
 
-        guild_config = get_guild_config(message.guild.id, 'pendingrole')
-        if guild_config is None:
+        # Already being granted the roles; skip fetching the member again
+        if (message.guild.id, message.author.id) in self.grants:
+            self.grants_deduplicated += 1
             return
 
-        role_ids = guild_config['roles']
-        roles = [message.guild.get_role(role_id) for role_id in role_ids]
+        role_ids = get_guild_config(message.guild.id, 'pendingrole')['roles']
 
         member = message.author
         if not isinstance(message.author, disnake.Member):
@@ -49,30 +133,33 @@ class PendingRole(Cog):
             member = await message.guild.fetch_member(message.author.id)
 
         # if author has any of the roles in role_ids, skip
-        if any(role.id in role_ids for role in member.roles):
+        if self._has_roles(member, role_ids):
             return
 
-        if 'interaction' in guild_config['triggers']:
-            logger.debug(f'Adding roles {", ".join(str(x) for x in role_ids)} to {message.author.display_name}')
-            await message.author.add_roles(*roles, reason='[interaction/message] User no longer pending rule verification')
+        roles = [message.guild.get_role(role_id) for role_id in role_ids]
+        await self._add_roles(member, roles, '[interaction/message] User no longer pending rule verification')
 
     @commands.Cog.listener()
     async def on_voice_state_update(self,
                                     member: disnake.Member, before: disnake.VoiceState, after: disnake.VoiceState):
+        if member.id in self.verified[member.guild.id]:
+            return
+
         guild_config = get_guild_config(member.guild.id, 'pendingrole')
         if guild_config is None:
             return
 
+        if 'interaction' not in guild_config['triggers']:
+            return
+
         role_ids = guild_config['roles']
-        roles = [member.guild.get_role(role_id) for role_id in role_ids]
 
         # if member has any of the roles in role_ids, skip
-        if any(role.id in role_ids for role in member.roles):
+        if self._has_roles(member, role_ids):
             return
 
-        if 'interaction' in guild_config['triggers']:
-            logger.debug(f'Adding roles {", ".join(str(x) for x in role_ids)} to {member.display_name}')
-            await member.add_roles(*roles, reason='[interaction/voice] User no longer pending rule verification')
+        roles = [member.guild.get_role(role_id) for role_id in role_ids]
+        await self._add_roles(member, roles, '[interaction/voice] User no longer pending rule verification')
 
     @commands.slash_command(invoke_without_command=False, aliases=['pr'], guild_ids=command_guild_ids)
     async def pendingrole(self, ctx: disnake.ApplicationCommandInteraction):
@@ -80,11 +167,25 @@ class PendingRole(Cog):
 
     @pendingrole.sub_command()
     @commands.has_permissions(manage_messages=True)
-    async def manual(self, ctx: disnake.ApplicationCommandInteraction):
+    async def grants(self, ctx: disnake.ApplicationCommandInteraction):
+        """
+        View how many role grants were skipped because one was already in flight
+        """
+        await ctx.send(f'Role grants: {len(self.grants)} in flight, {self.grants_deduplicated} duplicates skipped; '
+                       f'{len(self.verified[ctx.guild.id])} members known to be verified', ephemeral=True)
+
+    @pendingrole.sub_command()
+    @commands.has_permissions(manage_messages=True)
+    async def manual(self,
+                     ctx: disnake.ApplicationCommandInteraction,
+                     restart: bool = commands.Param(
+                         False,
+                         name='restart',
+                         description='Start over instead of resuming an interrupted run')):
         """
         Manually verifies all rule-verified users
         """
-        if ctx.guild.id in self.manually_processing:
+        if ctx.guild.id in self.manual_runs:
             await ctx.send('Already processing members, please wait...', ephemeral=True)
             return
 
@@ -92,34 +193,139 @@ class PendingRole(Cog):
         if guild_config is None:
             return
 
-        role_ids = guild_config['roles']
-        roles = [ctx.guild.get_role(role_id) for role_id in role_ids]
-
-        await ctx.send('Processing verified members...')
-        self.manually_processing.append(ctx.guild.id)
-
-        members = await ctx.guild.fetch_members(limit=None).flatten()
-        logger.debug(f'Processing {len(members)} members')
-
-        count = 0
-
-        for member in members:
-            if member.pending:
-                continue
-
-            if any(role.id in role_ids for role in member.roles):
-                continue
-
-            logger.debug(f'Adding roles {", ".join(str(x) for x in role_ids)} to {member.display_name}')
-            await member.add_roles(*roles, reason='[Manual] User no longer pending rule verification')
-            count += 1
-
-        if isinstance(ctx, disnake.ApplicationCommandInteraction):
-            await ctx.send(f'Finished verifying members; {count} updated')
+        cur = self.con.cursor()
+        cur.execute('''
+            SELECT last_member_id, processed
+            FROM pendingrole_runs
+            WHERE guild_id = ?
+        ''', (ctx.guild.id,))
+        row = cur.fetchone()
+        if row is not None and not restart:
+            cur.execute('''
+                UPDATE pendingrole_runs
+                SET channel_id = ?
+                WHERE guild_id = ?
+            ''', (ctx.channel.id, ctx.guild.id))
+            await ctx.send(f'Resuming processing verified members after {row[1]:,} already checked...')
         else:
-            await ctx.followup.send(f'Finished verifying members; {count} updated')
+            cur.execute('''
+                INSERT OR REPLACE INTO pendingrole_runs (guild_id, channel_id, started_at)
+                VALUES (?, ?, ?)
+            ''', (ctx.guild.id, ctx.channel.id, int(time.time())))
+            await ctx.send('Processing verified members...')
+        cur.close()
+
+        self._start_manual_run(ctx.guild, ctx.channel)
+
+    def _start_manual_run(self, guild: disnake.Guild, channel: disnake.abc.Messageable):
+        task = asyncio.create_task(self._run_manual(guild, channel))
+        self.manual_runs[guild.id] = task
+        task.add_done_callback(lambda _: self.manual_runs.pop(guild.id, None))
+
+    async def _resume_manual_runs(self):
+        await self.bot.wait_until_ready()
+        cur = self.con.cursor()
+        cur.execute('''
+            SELECT guild_id, channel_id
+            FROM pendingrole_runs
+        ''')
+        for (guild_id, channel_id) in cur.fetchall():
+            guild = self.bot.get_guild(guild_id)
+            channel = self.bot.get_channel(channel_id)
+            if guild is None or channel is None or get_guild_config(guild_id, 'pendingrole') is None:
+                cur.execute('''
+                    DELETE FROM pendingrole_runs
+                    WHERE guild_id = ?
+                ''', (guild_id,))
+                continue
+            if guild_id not in self.manual_runs:
+                logger.info(f'Resuming interrupted /pendingrole manual run in {guild.name}')
+                self._start_manual_run(guild, channel)
+        cur.close()
 
-        self.manually_processing.remove(ctx.guild.id)
+    async def _run_manual(self, guild: disnake.Guild, channel: disnake.abc.Messageable):
+        """
+        Adds the roles to every non-pending member without them, streaming members a page at a time
+        in ID order and checkpointing after each page so an interrupted run can pick up where it stopped.
+        """
+        role_ids = get_guild_config(guild.id, 'pendingrole')['roles']
+        roles = [guild.get_role(role_id) for role_id in role_ids]
+
+        cur = self.con.cursor()
+        cur.execute('''
+            SELECT last_member_id, processed, updated, failed
+            FROM pendingrole_runs
+            WHERE guild_id = ?
+        ''', (guild.id,))
+        (last_member_id, processed, updated, failed) = cur.fetchone()
+        cur.close()
+        counts = {'updated': updated, 'failed': failed}
+
+        def progress() -> str:
+            total = f'/{guild.member_count:,}' if guild.member_count else ''
+            return f'{processed:,}{total} members checked, {counts["updated"]:,} updated, {counts["failed"]:,} failed'
+
+        # A channel message rather than the interaction response, which can only be edited for 15 minutes
+        status = await channel.send(f'Processing verified members... {progress()}')
+        last_edit = time.monotonic()
+
+        # Bounded so only about a page of members is held in memory at once
+        queue = asyncio.Queue(manual_page_size)
+        workers = [asyncio.create_task(self._grant_roles(queue, roles, counts)) for _ in range(manual_workers)]
+        after = disnake.Object(last_member_id) if last_member_id > 0 else None
+        try:
+            async for page in guild.fetch_members(limit=None, after=after).chunk(manual_page_size):
+                for member in page:
+                    if member.pending:
+                        continue
+                    if self._has_roles(member, role_ids):
+                        continue
+                    await queue.put(member)
+                # Everyone in the page is done once the queue drains. disnake fetches pages in ascending ID order
+                # but yields each one highest ID first, and chunks line up with its pages since they're the same size,
+                # so everyone up to the page's highest ID has been checked
+                await queue.join()
+                processed += len(page)
+                self.con.execute('''
+                    UPDATE pendingrole_runs
+                    SET last_member_id = ?, processed = ?, updated = ?, failed = ?
+                    WHERE guild_id = ?
+                ''', (max(member.id for member in page), processed, counts['updated'], counts['failed'], guild.id))
+
+                if time.monotonic() - last_edit >= manual_progress_interval:
+                    last_edit = time.monotonic()
+                    try:
+                        await status.edit(content=f'Processing verified members... {progress()}')
+                    except disnake.HTTPException as e:
+                        logger.warning(f'Could not update /pendingrole manual progress: {e}')
+        except disnake.HTTPException as e:
+            logger.error(f'/pendingrole manual in {guild.name} stopped: {e}')
+            await channel.send(f'Stopped verifying members after {progress()}; run `/pendingrole manual` to resume')
+            return
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        self.con.execute('''
+            DELETE FROM pendingrole_runs
+            WHERE guild_id = ?
+        ''', (guild.id,))
+        logger.debug(f'Finished /pendingrole manual in {guild.name}: {progress()}')
+        await channel.send(f'Finished verifying members; {counts["updated"]:,} updated, {counts["failed"]:,} failed')
+
+    async def _grant_roles(self, queue: asyncio.Queue, roles: list[disnake.Role], counts: dict[str, int]):
+        while True:
+            member = await queue.get()
+            try:
+                await retry_rate_limited(
+                    lambda: self._add_roles(member, roles, '[Manual] User no longer pending rule verification'),
+                    manual_rate_limit_attempts, manual_rate_limit_pause, 'adding roles')
+                counts['updated'] += 1
+            except disnake.HTTPException as e:
+                logger.error(f'Could not add roles to {member.display_name}: {e}')
+                counts['failed'] += 1
+            finally:
+                queue.task_done()
 
 
 def setup(bot: commands.Bot):
@@ -1,7 +1,9 @@
+import asyncio
+from collections import deque
 import re
 import sqlite3
+import sys
 import time
-from typing import Callable
 
 import disnake
 from disnake.ext import commands
@@ -9,8 +11,291 @@ from loguru import logger
 
 from main import command_guild_ids, config
 from cog import Cog
+from db import BatchWriter, migrate
+from member_index import member_choices, search_members
+from utils import LRUCache
 
 silent = config['reactions']['silent']
+# Fetch every reacted message over REST instead of counting reactions in memory
+fetch_messages = config['reactions'].get('fetch_messages', False)
+# The reaction log is committed every write_interval_ms or write_batch_rows rows, whichever comes first
+write_interval_ms = config['reactions'].get('write_interval_ms', 250)
+write_batch_rows = config['reactions'].get('write_batch_rows', 500)
+# New patterns must search every adversarial emoji in CHECK_PATTERN_SCRIPT within this budget
+pattern_budget_ms = config['reactions'].get('pattern_budget_ms', 50)
+# Groups are suspended once their regex spends this long matching within one window of group_time_window_s
+group_time_budget_ms = config['reactions'].get('group_time_budget_ms', 1000)
+group_time_window_s = config['reactions'].get('group_time_window_s', 60)
+# Minimum time between reaction removals in the same channel
+removal_interval_ms = config['reactions'].get('removal_interval_ms', 250)
+
+# Times a pattern against emoji shaped to trigger catastrophic backtracking; run in a
+# subprocess since a regex can't be interrupted once it starts matching
+CHECK_PATTERN_SCRIPT = '''
+import re
+import sys
+import time
+
+pattern = re.compile(sys.argv[1], re.IGNORECASE)
+names = ['a' * 32, 'a' * 31 + '!', '_' * 32, '0' * 32, 'aA0_' * 8, 'a' * 16 + '_' * 16]
+subjects = []
+for name in names:
+    subjects += [name, f':{name}:', f'<:{name}:{"1" * 19}>', f'<a:{name}:{"1" * 19}>', f'<:{name}:{"1" * 19}']
+subjects += [
+    '\\U0001F1EF\\U0001F1F5' * 16,
+    '\\U0001F1EF' * 31 + 'a',
+    '\\U0001F468\\u200d\\U0001F469\\u200d\\U0001F467' * 8,
+    '\\U0001F600' * 32 + '!',
+    '\\u2764\\ufe0f' * 16,
+]
+start = time.perf_counter()
+for subject in subjects:
+    pattern.search(subject)
+print(time.perf_counter() - start)
+'''
+
+
+async def check_pattern(match: str) -> str | None:
+    """
+    Returns why the pattern can't be used for a reaction group, or None if it can.
+    """
+    try:
+        re.compile(match, re.IGNORECASE)
+    except re.error as e:
+        return f'Invalid regex: {e}'
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, '-c', CHECK_PATTERN_SCRIPT, match,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        # Leave time for the interpreter to start on top of the budget
+        (stdout, stderr) = await asyncio.wait_for(proc.communicate(), 1 + pattern_budget_ms / 1000)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return f'Regex took too long to match (over {pattern_budget_ms}ms)'
+    if proc.returncode != 0:
+        logger.error(f'Checking regex {match} failed: {stderr.decode()}')
+        return 'Regex could not be checked'
+    elapsed_ms = float(stdout) * 1000
+    if elapsed_ms > pattern_budget_ms:
+        return f'Regex took too long to match ({elapsed_ms:.0f}ms, over {pattern_budget_ms}ms)'
+    return None
+
+
+class ReactionGroupMatcher:
+    """
+    Compiled reaction groups and channel lists for a single guild.
+    """
+    # Patterns that refer to their own groups can't be merged into one alternation
+    GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+    # Matching is timed as a whole; once an emoji takes longer than this, each search of the next
+    # TIMED_MATCHES emoji is timed to find the slow group, so healthy groups don't pay for a clock read per search
+    SLOW_MATCH_NS = 5_000_000
+    TIMED_MATCHES = 100
+    # Timed searches faster than this aren't counted toward a group's budget
+    SLOW_SEARCH_NS = 100_000
+
+    def __init__(self):
+        # (name, enabled, match, match_type, compiled pattern) in row order
+        self.groups = []
+        self.whitelist = frozenset()
+        self.blacklist = frozenset()
+        # emoji -> hit groups; the same few emoji make up nearly every reaction
+        self.hits = LRUCache(4_096)
+        # Alternations of every substring/exact pattern, to rule out most emoji with a single search
+        self.substring_filter = None
+        self.exact_filter = None
+        self.exact_matches = frozenset()
+        # group name -> nanoseconds spent in slow searches of its regex during the current window
+        self.match_time = {}
+        self.window_start = time.monotonic()
+        # Emoji left whose searches are timed one by one, after a slow match
+        self.timed_matches = 0
+        # names of groups over group_time_budget_ms, to be suspended by the cog
+        self.over_budget = []
+
+    def add_group(self, name: str, enabled: bool, match: str, match_type: int):
+        try:
+            pattern = re.compile(match, re.IGNORECASE)
+        except re.error as e:
+            logger.error(f'Skipping reaction group {name}; invalid regex {match}: {e}')
+            return
+        self.groups.append((name, enabled, match, match_type, pattern))
+
+    def compile(self):
+        """
+        Builds the combined filters once every group has been added.
+        """
+        self.hits.clear()
+        self.substring_filter = self._compile_filter(Reactions.MATCH_TYPE_SUBSTRING)
+        self.exact_filter = self._compile_filter(Reactions.MATCH_TYPE_EXACT)
+        self.exact_matches = frozenset(group[2] for group in self.groups if group[3] == Reactions.MATCH_TYPE_EXACT)
+
+    def _compile_filter(self, match_type: int) -> re.Pattern | bool:
+        """
+        Returns one pattern matching wherever any group of the type would, False if there are
+        no such groups, or True if they can't be combined and each must always be checked.
+        """
+        matches = [group[2] for group in self.groups if group[3] == match_type]
+        if len(matches) == 0:
+            return False
+        if any(self.GROUP_REFERENCE.search(match) for match in matches):
+            return True
+        try:
+            return re.compile('|'.join(f'(?:{match})' for match in matches), re.IGNORECASE)
+        except re.error:
+            return True
+
+    def set_channel_lists(self, whitelist: set[int], blacklist: set[int]):
+        self.whitelist = frozenset(whitelist)
+        self.blacklist = frozenset(blacklist)
+
+    def skip_removal(self, channel_id: int) -> bool:
+        """
+        Returns whether the channel is whitelisted from reaction removals.
+        A channel on both a whitelist and a blacklist is treated as blacklisted.
+        """
+        return channel_id in self.whitelist and channel_id not in self.blacklist
+
+    def match(self, emoji: str) -> list[tuple[str, bool]]:
+        """
+        Returns (name, enabled) for every group the emoji hits, in row order.
+        """
+        hit_groups = self.hits.get(emoji)
+        if hit_groups is None:
+            start = time.perf_counter_ns()
+            hit_groups = self._match(emoji)
+            if time.perf_counter_ns() - start >= self.SLOW_MATCH_NS:
+                self.timed_matches = self.TIMED_MATCHES
+            self.hits[emoji] = hit_groups
+        return hit_groups
+
+    def _match(self, emoji: str) -> list[tuple[str, bool]]:
+        emoji_name = emoji.split(':')[1] if ':' in emoji else emoji
+        timing_searches = self.timed_matches > 0
+        if timing_searches:
+            self.timed_matches -= 1
+            # The filters run every pattern too, so they'd hide which one is slow
+            check_substring = check_exact = True
+        else:
+            check_substring = self.substring_filter is True or (self.substring_filter and self.substring_filter.search(emoji))
+            check_exact = (self.exact_filter is True or emoji in self.exact_matches
+                           or (self.exact_filter and self.exact_filter.search(emoji_name)))
+        hit_groups = []
+        if not check_substring and not check_exact:
+            return hit_groups
+        for (name, enabled, match, match_type, pattern) in self.groups:
+            if match_type == Reactions.MATCH_TYPE_SUBSTRING:
+                if not check_substring:
+                    continue
+                subject = emoji
+            elif match_type == Reactions.MATCH_TYPE_EXACT:
+                if not check_exact:
+                    continue
+                # Exact string match
+                if emoji == match:
+                    hit_groups.append((name, enabled))
+                    continue
+                subject = emoji_name
+            else:
+                continue
+            if timing_searches:
+                start = time.perf_counter_ns()
+                hit = pattern.search(subject)
+                elapsed = time.perf_counter_ns() - start
+                if elapsed >= self.SLOW_SEARCH_NS:
+                    self._record_slow_search(name, elapsed)
+            else:
+                hit = pattern.search(subject)
+            if hit:
+                hit_groups.append((name, enabled))
+        return hit_groups
+
+    def _record_slow_search(self, name: str, elapsed: int):
+        # Time spent only counts within the current window
+        now = time.monotonic()
+        if now - self.window_start >= group_time_window_s:
+            self.match_time.clear()
+            self.window_start = now
+        spent = self.match_time.get(name, 0) + elapsed
+        self.match_time[name] = spent
+        if spent > group_time_budget_ms * 1_000_000 and name not in self.over_budget:
+            self.over_budget.append(name)
+
+
+class ReactionRemover:
+    """
+    Removes reactions through one queue per channel, so bursts are paced per route
+    instead of all hitting the API at once.
+    """
+    def __init__(self, bot: commands.Bot, writer: BatchWriter):
+        self.bot = bot
+        self.writer = writer
+        # channel ID -> queue of pending removal keys
+        self.queues = {}
+        # channel ID -> task draining that channel's queue
+        self.workers = {}
+        # (guild ID, channel ID, message ID, user ID, emoji) -> (partial emoji, times of the logged reactions)
+        self.pending = {}
+
+    def schedule(self, payload: disnake.RawReactionActionEvent, time: int):
+        """
+        Queues the reaction for removal; repeats of one already queued are folded into it.
+        """
+        key = (payload.guild_id, payload.channel_id, payload.message_id, payload.user_id, str(payload.emoji))
+        if key in self.pending:
+            self.pending[key][1].append(time)
+            return
+        self.pending[key] = (payload.emoji, [time])
+        self.queues.setdefault(payload.channel_id, deque()).append(key)
+        if payload.channel_id not in self.workers:
+            self.workers[payload.channel_id] = asyncio.create_task(self._drain(payload.channel_id))
+
+    def depth(self) -> dict[int, int]:
+        """
+        Returns the number of queued removals per channel ID.
+        """
+        return {channel_id: len(queue) for (channel_id, queue) in self.queues.items() if len(queue) > 0}
+
+    def close(self):
+        for worker in self.workers.values():
+            worker.cancel()
+        if len(self.pending) > 0:
+            logger.warning(f'Dropping {len(self.pending)} queued reaction removals')
+
+    async def _drain(self, channel_id: int):
+        queue = self.queues[channel_id]
+        try:
+            while len(queue) > 0:
+                key = queue[0]
+                await self._remove(key)
+                queue.popleft()
+                del self.pending[key]
+                await asyncio.sleep(removal_interval_ms / 1000)
+        finally:
+            del self.workers[channel_id]
+            if len(queue) == 0:
+                del self.queues[channel_id]
+
+    async def _remove(self, key: tuple[int, int, int, int, str]):
+        (guild_id, channel_id, message_id, user_id, emoji) = key
+        message = self.bot.get_partial_messageable(channel_id).get_partial_message(message_id)
+        try:
+            await message.remove_reaction(self.pending[key][0], disnake.Object(user_id))
+            removed = Reactions.REACTION_REMOVED_BOT
+        except disnake.NotFound:
+            # Already gone; on_raw_reaction_remove has recorded how
+            return
+        except disnake.HTTPException as e:
+            logger.error(f'Could not remove {emoji} by {user_id} on message {message_id}: {e}')
+            removed = Reactions.REACTION_REMOVED_FAILED
+        times = self.pending[key][1]
+        self.writer.execute(f'''
+            UPDATE reactions
+            SET removed = ?
+            WHERE message_id = ? AND channel_id = ? AND guild_id = ? AND user_id = ? AND emoji = ?
+                AND time IN ({",".join("?" * len(times))})
+        ''', (removed, message_id, channel_id, guild_id, user_id, emoji, *times))
 
 
 class Reactions(Cog):
@@ -29,75 +314,147 @@ class Reactions(Cog):
 
     def __init__(self, bot: commands.Bot):
         super().__init__(bot)
-        # TABLE: reactions
-        # nth = which reaction of this type it was (first = 1, second = 2, etc.)
+        migrate(self.con)
         cur = self.con.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS reactions (
-                message_id INTEGER NOT NULL,
-                channel_id INTEGER NOT NULL,
-                guild_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                emoji TEXT NOT NULL,
-                removed INTEGER DEFAULT 0,
-                nth INTEGER NOT NULL,
-                time INTEGER NOT NULL,
-                hit_groups TEXT,
-                PRIMARY KEY (message_id, channel_id, guild_id, emoji, time)
-            );
-        ''')
-        # TABLE: reaction_groups
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS reaction_groups (
-                guild_id INTEGER NOT NULL,
-                enabled INTEGER NOT NULL DEFAULT 1,
-                name TEXT NOT NULL,
-                match TEXT NOT NULL,
-                match_type INTEGER NOT NULL DEFAULT 0,
-                builtin INTEGER NOT NULL DEFAULT 0,
-                channel_list_type INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY (guild_id, name)
-            );
-        ''')
         # Add built-in reaction groups
         for guild_id in config['bot']['guilds']:
             cur.execute('''
                 INSERT OR REPLACE INTO reaction_groups (guild_id, name, match, builtin)
                 VALUES (?, ?, ?, ?)
             ''', (guild_id, 'Country Flags', r'[\U0001F1E6-\U0001F1FF]{2}', 1))
-        # TABLE: reaction_groups_channel_lists
-        # channel_ids is comma-separated
+        cur.close()
+        # guild ID -> ReactionGroupMatcher
+        self.matchers = {}
+        self._load_matchers()
+        # message ID -> {emoji: current reaction count}
+        self.reaction_counts = LRUCache(10_000)
+        # Reactions on messages sent after this were all seen by the listeners
+        self.counting_since = disnake.utils.time_snowflake(disnake.utils.utcnow())
+        # user ID -> disnake.User, or None if the user doesn't exist
+        self.users = LRUCache(5_000)
+        # Limits concurrent user fetches across all commands
+        self.user_fetches = asyncio.Semaphore(8)
+        # Reaction adds/removals are logged off the event loop
+        self.writer = BatchWriter('neurobot.db', write_interval_ms / 1000, write_batch_rows)
+        self.remover = ReactionRemover(bot, self.writer)
+
+    def cog_unload(self):
+        super().cog_unload()
+        self.remover.close()
+        self.writer.close()
+
+    def _load_matchers(self, guild_id: int = None):
+        """
+        Builds the reaction group matchers for all guilds, or only the given guild.
+        """
+        cur = self.con.cursor()
+        if guild_id is None:
+            self.matchers = {}
+            cur.execute('''
+                SELECT guild_id, name, match, match_type, enabled
+                FROM reaction_groups
+                WHERE suspended = 0
+            ''')
+        else:
+            self.matchers[guild_id] = ReactionGroupMatcher()
+            cur.execute('''
+                SELECT guild_id, name, match, match_type, enabled
+                FROM reaction_groups
+                WHERE guild_id = ? AND suspended = 0
+            ''', (guild_id,))
+        for row in cur.fetchall():
+            matcher = self.matchers.setdefault(row[0], ReactionGroupMatcher())
+            matcher.add_group(row[1], row[4], row[2], row[3])
+        if guild_id is None:
+            cur.execute('''
+                SELECT guild_id, type, channel_id
+                FROM reaction_groups_channels
+            ''')
+        else:
+            cur.execute('''
+                SELECT guild_id, type, channel_id
+                FROM reaction_groups_channels
+                WHERE guild_id = ?
+            ''', (guild_id,))
+        # guild ID -> (whitelisted channel IDs, blacklisted channel IDs)
+        channel_lists = {}
+        for row in cur.fetchall():
+            (whitelist, blacklist) = channel_lists.setdefault(row[0], (set(), set()))
+            if row[1] == Reactions.CHANNEL_LIST_TYPE_WHITELIST:
+                whitelist.add(row[2])
+            elif row[1] == Reactions.CHANNEL_LIST_TYPE_BLACKLIST:
+                blacklist.add(row[2])
+        for (list_guild_id, (whitelist, blacklist)) in channel_lists.items():
+            matcher = self.matchers.setdefault(list_guild_id, ReactionGroupMatcher())
+            matcher.set_channel_lists(whitelist, blacklist)
+        cur.close()
+        if guild_id is None:
+            for matcher in self.matchers.values():
+                matcher.compile()
+        else:
+            self.matchers[guild_id].compile()
+
+    def _suspend_groups(self, guild_id: int, names: list[str]):
+        """
+        Disables and stops evaluating groups whose regex has been too slow.
+        """
+        for name in names:
+            logger.warning(f'Suspending reaction group {name} in guild {guild_id}; its regex spent over {group_time_budget_ms}ms matching within {group_time_window_s}s')
+            self.con.execute('''
+                UPDATE reaction_groups
+                SET enabled = 0, suspended = 1
+                WHERE guild_id = ? AND name = ?
+            ''', (guild_id, name))
+        self._load_matchers(guild_id)
+
+    async def _get_reaction_count(self, payload: disnake.RawReactionActionEvent, emoji: str) -> int | None:
+        """
+        Returns the current count of the emoji on the message before this reaction,
+        or None if it isn't known without fetching the message.
+        """
+        counts = self.reaction_counts.get(payload.message_id)
+        if counts is not None and emoji in counts:
+            return counts[emoji]
+        # Reactions and removals still queued for the log would be missing from the count
+        await asyncio.to_thread(self.writer.flush)
+        # Another reaction may have counted the emoji in the meantime
+        counts = self.reaction_counts.get(payload.message_id)
+        if counts is not None and emoji in counts:
+            return counts[emoji]
+        # Reactions the bot failed to remove are still on the message
+        cur = self.con.cursor()
         cur.execute('''
-            CREATE TABLE IF NOT EXISTS reaction_groups_channel_lists (
-                guild_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                type INTEGER NOT NULL DEFAULT 0,
-                channel_ids TEXT NOT NULL,
-                PRIMARY KEY (guild_id, name, type)
-            );
-        ''')
+            SELECT COUNT(*), SUM(removed IN (0, 3))
+            FROM reactions
+            WHERE message_id = ? AND channel_id = ? AND guild_id = ? AND emoji = ?
+        ''', (payload.message_id, payload.channel_id, payload.guild_id, emoji))
+        (total, active) = cur.fetchone()
         cur.close()
+        if total > 0:
+            return active
+        # Nothing logged for a message we've watched since it was sent means no reactions yet
+        if payload.message_id > self.counting_since:
+            return 0
+        return None
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload: disnake.RawReactionActionEvent):
-        try:
-            message = await self.bot.get_channel(payload.channel_id).fetch_message(payload.message_id)
-        except disnake.NotFound:
-            logger.error(f'Could not find message {payload.message_id} in channel {payload.channel_id}')
-            return
-        emoji = str(payload.emoji)
-        removed = 0
+    def _set_reaction_count(self, message_id: int, emoji: str, count: int):
+        counts = self.reaction_counts.get(message_id)
+        if counts is None:
+            counts = {}
+            self.reaction_counts[message_id] = counts
+        counts[emoji] = max(count, 0)
 
+    def _get_nth_from_message(self, message: disnake.Message, payload: disnake.RawReactionActionEvent, emoji: str) -> int:
         same_reaction = [r for r in message.reactions if str(r.emoji) == emoji]
 
         cur = self.con.cursor()
-
         cur.execute('''
             SELECT nth
             FROM reactions
             WHERE message_id = ? AND channel_id = ? AND guild_id = ? AND emoji = ?
         ''', (payload.message_id, payload.channel_id, payload.guild_id, emoji))
         rows = cur.fetchall()
+        cur.close()
 
         # If the user spam reacts/unreacts, the message cache doesn't have the
         # reaction yet, so assume its nth based on what we already have
@@ -112,76 +469,77 @@ class Reactions(Cog):
                 nth = len(rows) + 1
             else:
                 nth = same_reaction[0].count
+        return nth
 
-        now = time.time_ns() // 1_000_000
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: disnake.RawReactionActionEvent):
+        emoji = str(payload.emoji)
 
-        skip_removal = False
+        count = None if fetch_messages else await self._get_reaction_count(payload, emoji)
+        if count is not None:
+            nth = count + 1
+        else:
+            try:
+                message = await self.bot.get_channel(payload.channel_id).fetch_message(payload.message_id)
+            except disnake.NotFound:
+                logger.error(f'Could not find message {payload.message_id} in channel {payload.channel_id}')
+                return
+            nth = self._get_nth_from_message(message, payload, emoji)
+        self._set_reaction_count(payload.message_id, emoji, nth)
 
-        # Find any whitelists/blacklists that apply to this channel
-        cur.execute('''
-            SELECT name, type, channel_ids
-            FROM reaction_groups_channel_lists
-            WHERE guild_id = ?
-        ''', (payload.guild_id,))
-        for row in cur.fetchall():
-            name = row[0]
-            type = row[1]
-            channel_ids = row[2].split(',')
-            if str(payload.channel_id) in channel_ids:
-                if type == Reactions.CHANNEL_LIST_TYPE_WHITELIST:
-                    skip_removal = True
-                elif type == Reactions.CHANNEL_LIST_TYPE_BLACKLIST:
-                    skip_removal = False
-                break
+        now = time.time_ns() // 1_000_000
 
-        # Check if the reaction matches any reaction groups
-        cur.execute('''
-            SELECT name, match, match_type, enabled
-            FROM reaction_groups
-            WHERE guild_id = ?
-        ''', (payload.guild_id,))
-        # We keep track of all hit groups even if disabled
-        hit_groups = []
-        for row in cur.fetchall():
-            name = row[0]
-            match = row[1]
-            match_type = row[2]
-            enabled = row[3]
+        matcher = self.matchers.get(payload.guild_id)
+        if matcher is None:
+            skip_removal = False
+            hit_groups = []
+        else:
+            # Whitelisted channels keep their reactions
+            skip_removal = matcher.skip_removal(payload.channel_id)
+            # We keep track of all hit groups even if disabled
+            hit_groups = matcher.match(emoji)
+            if len(matcher.over_budget) > 0:
+                self._suspend_groups(payload.guild_id, matcher.over_budget)
 
-            if match_type == Reactions.MATCH_TYPE_SUBSTRING:
-                if bool(re.search(match, emoji, re.IGNORECASE)):
-                    hit_groups.append((name, enabled))
-            elif match_type == Reactions.MATCH_TYPE_EXACT:
-                # Exact string match
-                emoji_name = emoji.split(':')[1] if ':' in emoji else emoji
-                if emoji == match or bool(re.search(match, emoji_name, re.IGNORECASE)):
-                    hit_groups.append((name, enabled))
         # If any hit groups are enabled, remove the reaction, and keep track of which group hit first
         first_hit_group = None
+        remove = False
         for (name, enabled) in hit_groups:
             first_hit_group = name
             if enabled and not skip_removal:
-                try:
-                    await message.remove_reaction(payload.emoji, payload.member)
-                    removed = Reactions.REACTION_REMOVED_BOT
-                except disnake.Forbidden:
-                    removed = Reactions.REACTION_REMOVED_FAILED
+                remove = True
                 break
         hit_groups_str = ','.join((f'{name}::{enabled}' if name != first_hit_group else f'{name}::*') for (name, enabled) in hit_groups)
-        self.con.execute('''
+        # The removed state is filled in by the remover once the removal goes through
+        self.writer.execute('''
             INSERT INTO reactions (message_id, channel_id, guild_id, user_id, emoji, removed, nth, time, hit_groups)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (payload.message_id, payload.channel_id, payload.guild_id, payload.user_id, emoji, removed, nth, now, hit_groups_str))
+        ''', (payload.message_id, payload.channel_id, payload.guild_id, payload.user_id, emoji, 0, nth, now, hit_groups_str))
+        if remove:
+            self.remover.schedule(payload, now)
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload: disnake.RawReactionActionEvent):
         emoji = str(payload.emoji)
-        self.con.execute('''
+        counts = self.reaction_counts.get(payload.message_id)
+        if counts is not None and emoji in counts:
+            counts[emoji] = max(counts[emoji] - 1, 0)
+        self.writer.execute('''
             UPDATE reactions
             SET removed = ?
-            WHERE message_id = ? AND channel_id = ? AND guild_id = ? AND user_id = ? AND emoji = ? AND removed = 0
+            WHERE message_id = ? AND channel_id = ? AND guild_id = ? AND user_id = ? AND emoji = ? AND removed IN (0, 3)
         ''', (Reactions.REACTION_REMOVED_SELF, payload.message_id, payload.channel_id, payload.guild_id, payload.user_id, emoji))
 
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, payload: disnake.RawReactionClearEvent):
+        self.reaction_counts.pop(payload.message_id, None)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, payload: disnake.RawReactionClearEmojiEvent):
+        counts = self.reaction_counts.get(payload.message_id)
+        if counts is not None:
+            counts.pop(str(payload.emoji), None)
+
     def _format_reaction_groups(self, groups: list[str]):
         if len(groups) == 0:
             return 'No reaction groups found.'
@@ -222,13 +580,13 @@ class Reactions(Cog):
         """
         cur = self.con.cursor()
         cur.execute('''
-            SELECT name, enabled, builtin
+            SELECT name, enabled, builtin, suspended
             FROM reaction_groups
             WHERE guild_id = ?
         ''', (ctx.guild.id,))
         names = []
         for row in cur.fetchall():
-            name = row[0] + (' (enabled)' if row[1] else ' (disabled)') + (' (built-in)' if row[2] == 1 else '')
+            name = row[0] + (' (enabled)' if row[1] else ' (disabled)') + (' (built-in)' if row[2] == 1 else '') + (' (suspended)' if row[3] else '')
             names.append(name)
         cur.close()
         await ctx.send(self._format_reaction_groups(names), ephemeral=silent)
@@ -277,7 +635,7 @@ class Reactions(Cog):
         # Check if group exists
         cur = self.con.cursor()
         cur.execute('''
-            SELECT builtin
+            SELECT builtin, match, suspended
             FROM reaction_groups
             WHERE (guild_id = ? OR builtin = 1) AND LOWER(name) = ?
         ''', (ctx.guild.id, name.lower()))
@@ -285,12 +643,19 @@ class Reactions(Cog):
         if group is None:
             await ctx.send(f'Reaction group `{name}` does not exist', ephemeral=silent)
             return
+        # Suspended groups must pass the regex check again
+        if group[2]:
+            error = await check_pattern(group[1])
+            if error is not None:
+                await ctx.send(f'Reaction group `{name}` is suspended and cannot be enabled: {error}', ephemeral=silent)
+                return
         # Group exists; we can enable
         self.con.execute('''
             UPDATE reaction_groups
-            SET enabled = 1
+            SET enabled = 1, suspended = 0
             WHERE guild_id = ? AND LOWER(name) = ?
         ''', (ctx.guild.id, name.lower()))
+        self._load_matchers(ctx.guild.id)
         await ctx.send(f'Reaction group `{name}` enabled', ephemeral=silent)
 
     @enable.autocomplete('name')
@@ -326,6 +691,7 @@ class Reactions(Cog):
             SET enabled = 0
             WHERE guild_id = ? AND LOWER(name) = ?
         ''', (ctx.guild.id, name.lower()))
+        self._load_matchers(ctx.guild.id)
         await ctx.send(f'Reaction group `{name}` disabled', ephemeral=silent)
 
     @disable.autocomplete('name')
@@ -361,12 +727,17 @@ class Reactions(Cog):
         if group is not None:
             await ctx.send(f'Reaction group `{name}` already exists', ephemeral=silent)
             return
+        error = await check_pattern(match)
+        if error is not None:
+            await ctx.send(f'Reaction group `{name}` not added: {error}', ephemeral=silent)
+            return
         # Group doesn't exist; we can add
         cur.execute('''
             INSERT INTO reaction_groups (guild_id, name, match, match_type)
             VALUES (?, ?, ?, ?)
         ''', (ctx.guild.id, name, match, self._match_type_to_int(match_type)))
         cur.close()
+        self._load_matchers(ctx.guild.id)
         await ctx.send(f'Reaction group `{name}` added with match `{match}`', ephemeral=silent)
 
     @reactiongroups.sub_command()
@@ -401,13 +772,18 @@ class Reactions(Cog):
         if group[0]:
             await ctx.send(f'Cannot edit built-in reaction group `{name}`', ephemeral=silent)
             return
+        error = await check_pattern(match)
+        if error is not None:
+            await ctx.send(f'Reaction group `{name}` not edited: {error}', ephemeral=silent)
+            return
         # Group exists and isn't built-in; we can edit
         cur.execute('''
             UPDATE reaction_groups
-            SET match = ?, match_type = ?
+            SET match = ?, match_type = ?, suspended = 0
             WHERE guild_id = ? AND LOWER(name) = ?
         ''', (match, self._match_type_to_int(match_type), ctx.guild.id, name.lower()))
         cur.close()
+        self._load_matchers(ctx.guild.id)
         await ctx.send(f'Reaction group `{name}` edited with new match `{match}`', ephemeral=silent)
 
     @edit.autocomplete('name')
@@ -446,12 +822,144 @@ class Reactions(Cog):
             WHERE guild_id = ? AND LOWER(name) = ?
         ''', (ctx.guild.id, name.lower()))
         cur.close()
+        self._load_matchers(ctx.guild.id)
         await ctx.send(f'Reaction group `{name}` removed', ephemeral=silent)
 
     @remove.autocomplete('name')
     async def _remove_name_autocomplete(self, ctx: disnake.ApplicationCommandInteraction, name: str):
         return await self.get_group_names(ctx.guild_id, False)
 
+    def _list_type_to_int(self, list_type: str):
+        if list_type == 'whitelist':
+            return Reactions.CHANNEL_LIST_TYPE_WHITELIST
+        elif list_type == 'blacklist':
+            return Reactions.CHANNEL_LIST_TYPE_BLACKLIST
+        else:
+            raise ValueError(f'Invalid channel list type string: {list_type}')
+
+    @reactiongroups.sub_command_group()
+    async def channels(self, ctx: disnake.ApplicationCommandInteraction):
+        pass
+
+    @channels.sub_command(name='add')
+    @commands.has_permissions(manage_messages=True)
+    async def channels_add(self,
+                           ctx: disnake.ApplicationCommandInteraction,
+                           list_type: str = commands.Param(
+                               name='type',
+                               description='Whitelisted channels keep matching reactions, blacklisted ones don\'t',
+                               choices=['whitelist', 'blacklist']),
+                           channel: disnake.abc.GuildChannel = commands.Param(
+                               name='channel',
+                               description='The channel to add'),
+                           list_name: str = commands.Param(
+                               'default',
+                               name='list',
+                               description='The name of the channel list')):
+        """
+        Add a channel to a reaction group channel list
+        """
+        cur = self.con.cursor()
+        cur.execute('''
+            INSERT OR IGNORE INTO reaction_groups_channels (guild_id, list_name, type, channel_id)
+            VALUES (?, ?, ?, ?)
+        ''', (ctx.guild.id, list_name, self._list_type_to_int(list_type), channel.id))
+        added = cur.rowcount > 0
+        cur.close()
+        if not added:
+            await ctx.send(f'{channel.mention} is already in {list_type} `{list_name}`', ephemeral=silent)
+            return
+        self._load_matchers(ctx.guild.id)
+        await ctx.send(f'Added {channel.mention} to {list_type} `{list_name}`', ephemeral=silent)
+
+    @channels.sub_command(name='remove')
+    @commands.has_permissions(manage_messages=True)
+    async def channels_remove(self,
+                              ctx: disnake.ApplicationCommandInteraction,
+                              list_type: str = commands.Param(
+                                  name='type',
+                                  description='The type of channel list',
+                                  choices=['whitelist', 'blacklist']),
+                              channel: disnake.abc.GuildChannel = commands.Param(
+                                  name='channel',
+                                  description='The channel to remove'),
+                              list_name: str = commands.Param(
+                                  'default',
+                                  name='list',
+                                  description='The name of the channel list')):
+        """
+        Remove a channel from a reaction group channel list
+        """
+        cur = self.con.cursor()
+        cur.execute('''
+            DELETE FROM reaction_groups_channels
+            WHERE guild_id = ? AND list_name = ? AND type = ? AND channel_id = ?
+        ''', (ctx.guild.id, list_name, self._list_type_to_int(list_type), channel.id))
+        removed = cur.rowcount > 0
+        cur.close()
+        if not removed:
+            await ctx.send(f'{channel.mention} is not in {list_type} `{list_name}`', ephemeral=silent)
+            return
+        self._load_matchers(ctx.guild.id)
+        await ctx.send(f'Removed {channel.mention} from {list_type} `{list_name}`', ephemeral=silent)
+
+    @channels.sub_command(name='list')
+    @commands.has_permissions(manage_messages=True)
+    async def channels_list(self, ctx: disnake.ApplicationCommandInteraction):
+        """
+        List the reaction group channel lists
+        """
+        cur = self.con.cursor()
+        cur.execute('''
+            SELECT list_name, type, channel_id
+            FROM reaction_groups_channels
+            WHERE guild_id = ?
+            ORDER BY list_name, type
+        ''', (ctx.guild.id,))
+        # (list name, type) -> channel mentions
+        lists = {}
+        for (list_name, list_type, channel_id) in cur.fetchall():
+            lists.setdefault((list_name, list_type), []).append(f'<#{channel_id}>')
+        cur.close()
+        if len(lists) == 0:
+            await ctx.send('No channel lists found.', ephemeral=silent)
+            return
+        # Lists too long for one message continue on another line
+        lines = []
+        for ((list_name, list_type), mentions) in lists.items():
+            type_name = 'whitelist' if list_type == Reactions.CHANNEL_LIST_TYPE_WHITELIST else 'blacklist'
+            prefix = f'`{list_name}` ({type_name}): '
+            line = prefix + mentions[0]
+            for mention in mentions[1:]:
+                if len(line) + len(mention) + 2 > 2000:
+                    lines.append(line)
+                    line = prefix + mention
+                else:
+                    line += ', ' + mention
+            lines.append(line)
+        # Send the message once it can't fit another line
+        content = lines[0]
+        for line in lines[1:]:
+            if len(content) + len(line) + 1 > 2000:
+                await ctx.send(content, ephemeral=silent)
+                content = line
+            else:
+                content += '\n' + line
+        await ctx.send(content, ephemeral=silent)
+
+    @reactions.sub_command()
+    @commands.has_permissions(manage_messages=True)
+    async def removals(self, ctx: disnake.ApplicationCommandInteraction):
+        """
+        View reaction removals waiting to be sent
+        """
+        depth = self.remover.depth()
+        if len(depth) == 0:
+            await ctx.send('No reaction removals queued', ephemeral=silent)
+            return
+        lines = [f'<#{channel_id}>: {count}' for (channel_id, count) in sorted(depth.items(), key=lambda item: -item[1])]
+        await ctx.send(f'{sum(depth.values())} reaction removals queued:\n' + '\n'.join(lines[:50]), ephemeral=silent)
+
     @reactions.sub_command()
     @commands.has_permissions(manage_messages=True)
     async def first(self,
@@ -478,9 +986,9 @@ class Reactions(Cog):
                 return
             message_id = int(message_input)
 
-        cur = self.con.cursor()
+        # One row per emoji/user pair, in order of their first reaction
         query = '''
-            SELECT emoji, user_id, time, channel_id
+            SELECT emoji, user_id, GROUP_CONCAT(time), MIN(channel_id)
             FROM reactions
             WHERE message_id = ? AND guild_id = ? AND nth = 1
         '''
@@ -495,28 +1003,29 @@ class Reactions(Cog):
                 query += ' AND user_id = ?'
                 params += (int(filter_user),)
             else:
-                member_lambda: Callable[[disnake.Member], bool] = (lambda m:
-                                      (filter_user.lower() in m.name.lower()) or
-                                      (filter_user.lower() in m.display_name.lower()))
-                members = list(filter(member_lambda, ctx.guild.members))
+                members = search_members(ctx.guild, filter_user, None)
                 if len(members) == 0:
                     await ctx.send('No users found by that filter', ephemeral=silent)
                     return
-                elif len(members) > 1:
-                    query += 'AND user_id IN ('
-                    for member in members:
-                        query += '?,'
-                        params += (member.id,)
-                    query = query.removesuffix(',') + ')'
-                else:
-                    query += ' AND user_id = ?'
-                    params += (members[0].id,)
+                query += f' AND user_id IN ({",".join("?" * len(members))})'
+                params += tuple(member.id for member in members)
+
+        query += ' GROUP BY emoji, user_id ORDER BY MIN(time) ASC'
 
-        query += ' ORDER BY time ASC'
+        # Flushing the log and fetching users who left can outlast the 3 seconds an interaction has to respond
+        await ctx.response.defer()
 
+        # Make sure reactions still queued for the log are included
+        await asyncio.to_thread(self.writer.flush)
+
+        cur = self.con.cursor()
         cur.execute(query, params)
         reactions = cur.fetchall()
+        cur.close()
         if len(reactions) == 0:
+            if silent:
+                # The deferred response is public; replace it so this stays private
+                await ctx.delete_original_response()
             await ctx.send('No reactions found', ephemeral=silent)
             return
 
@@ -525,25 +1034,17 @@ class Reactions(Cog):
 
         title = 'First reactions'
         link_to_message = f'[Jump to message](https://discord.com/channels/{ctx.guild.id}/{channel_id}/{message_id})'
-        description = f'{link_to_message}\n\n'
         color = 0xAA8ED6
 
-        # chunks for the embed description
-        buffer = ''
-        # whether to use followup or send a single embed
-        followup = False
-
-        # keep track of emoji/user pairs for multiple reactions of the same
-        #  type from the same user
-        already_processed = []
+        # Members render from their mention alone; only users who left the guild
+        #  need fetching so their name can be shown
+        users = await self.resolve_users({row[1] for row in reactions if ctx.guild.get_member(row[1]) is None})
 
-        for row in reactions:
-            emoji = row[0]
-            user_id = row[1]
-
-            if (emoji, user_id) in already_processed:
-                continue
+        # lines of the embed being filled, and their length including newlines
+        lines = [link_to_message, '']
+        length = len(link_to_message) + 1
 
+        for (emoji, user_id, times, _) in reactions:
             emoji_url = None
 
             if '<' in emoji:
@@ -554,51 +1055,62 @@ class Reactions(Cog):
                 else:
                     emoji_url += '.png'
 
-            user = await self.bot.get_or_fetch_user(user_id)
-
-            same_reactions = list(filter(lambda r: r[0] == emoji and r[1] == user_id, reactions))
-            if len(same_reactions) > 1:
-                # since there's multiple of this emoji type from the same user,
-                #  keep track of it so we don't process it again
-                already_processed.append((same_reactions[0][0], same_reactions[0][1]))
-                buffer += f'{len(same_reactions)}x '
-
-            timestamps = list(map(lambda r: r[2] // 1000, same_reactions))
-
-            buffer = ''
+            timestamps = sorted(int(t) // 1000 for t in times.split(','))
 
             # 01:23:45 AM
-            buffer += ', '.join(f'<t:{timestamp}:T>' for timestamp in timestamps)
+            line = ', '.join(f'<t:{timestamp}:T>' for timestamp in timestamps)
 
             if ':' in emoji:
                 emoji = ('a' if emoji.startswith('<a') else '') + ':' + emoji.split(':')[1] + ':'
 
             if emoji_url is not None:
-                buffer += f'[`{emoji}`]({emoji_url})'
+                line += f'[`{emoji}`]({emoji_url})'
             else:
-                buffer += f'`{emoji}`'
+                line += f'`{emoji}`'
 
-            buffer += f' by {user.mention}' + (f' (**{len(same_reactions)}x**)' if len(same_reactions) > 1 else '') + '\n'
+            user = users.get(user_id)
+            line += f' by <@{user_id}>' + (f' (`{user}`)' if user is not None else '') + (f' (**{len(timestamps)}x**)' if len(timestamps) > 1 else '')
 
-            if len(description) + len(buffer) > 4096:
-                embed = disnake.Embed(title=title, description=description, color=color)
+            # Send the embed once it can't fit another line
+            if length + len(line) + 1 > 4096:
+                await ctx.send(embed=disnake.Embed(title=title, description='\n'.join(lines), color=color))
+                lines = [link_to_message, '']
+                length = len(link_to_message) + 1
 
-                await ctx.send(embed=embed)
+            lines.append(line)
+            length += len(line) + 1
 
-                description = f'{link_to_message}\n\n'
-                followup = True
+        await ctx.send(embed=disnake.Embed(title=title, description='\n'.join(lines), color=color))
 
-            description += buffer
+    @first.autocomplete('user')
+    async def _first_user_autocomplete(self, ctx: disnake.ApplicationCommandInteraction, user: str):
+        return member_choices(ctx.guild, user)
 
-        embed = disnake.Embed(title=title, description=description, color=color)
+    async def _fetch_user(self, user_id: int):
+        async with self.user_fetches:
+            try:
+                user = await self.bot.fetch_user(user_id)
+            except disnake.NotFound:
+                user = None
+        self.users[user_id] = user
 
-        if followup:
-            if isinstance(ctx, disnake.ApplicationCommandInteraction):
-                await ctx.send(embed=embed)
+    async def resolve_users(self, user_ids: set[int]) -> dict[int, disnake.User | None]:
+        """
+        Resolves users from the client cache or the user cache, fetching the rest concurrently.
+        """
+        users = {}
+        missing = []
+        for user_id in user_ids:
+            user = self.bot.get_user(user_id) or self.users.get(user_id, False)
+            if user is False:
+                missing.append(user_id)
             else:
-                await ctx.followup.send(embed=embed)
-        else:
-            await ctx.send(embed=embed)
+                users[user_id] = user
+        if len(missing) > 0:
+            await asyncio.gather(*(self._fetch_user(user_id) for user_id in missing))
+            for user_id in missing:
+                users[user_id] = self.users.get(user_id)
+        return users
 
     async def get_group_names(self, guild_id: int, builtin: bool = True):
         """
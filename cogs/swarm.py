@@ -1,9 +1,8 @@
 import disnake
 from disnake.ext import commands
 
-from main import command_guild_ids, config
+from main import command_guild_ids, config, router
 from cog import Cog
-from utils import get_guild_config
 
 
 class GuildState:
@@ -18,23 +17,19 @@ class Swarm(Cog):
         for x in command_guild_ids if str(x) in config['swarm']
     }
 
-    @commands.Cog.listener()
-    async def on_message(self, message: disnake.Message):
-        if message.author.bot:
-            return
-
-        if message.guild is None:
-            return
+    def __init__(self, bot: commands.Bot):
+        super().__init__(bot)
+        for guild_id in self.guilds:
+            router.register(guild_id, int(config['swarm'][str(guild_id)]['target_channel']), self.handle_message)
 
-        guild_config = get_guild_config(message.guild.id, 'swarm')
-        if guild_config is None:
-            return
-
-        target_channel_id = int(guild_config['target_channel'])
-
-        if message.channel.id != target_channel_id:
-            return
+    def cog_unload(self):
+        super().cog_unload()
+        router.unregister(self.handle_message)
 
+    async def handle_message(self, message: disnake.Message):
+        """
+        Handles messages in the target channel, routed by the message router.
+        """
         if not message.stickers:
             return
 
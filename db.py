@@ -0,0 +1,382 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+
+def _create_tables(cur: sqlite3.Cursor):
+    # TABLE: reactions
+    # nth = which reaction of this type it was (first = 1, second = 2, etc.)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS reactions (
+            message_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            emoji TEXT NOT NULL,
+            removed INTEGER DEFAULT 0,
+            nth INTEGER NOT NULL,
+            time INTEGER NOT NULL,
+            hit_groups TEXT,
+            PRIMARY KEY (message_id, channel_id, guild_id, emoji, time)
+        )
+    ''')
+    # TABLE: reaction_groups
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS reaction_groups (
+            guild_id INTEGER NOT NULL,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            name TEXT NOT NULL,
+            match TEXT NOT NULL,
+            match_type INTEGER NOT NULL DEFAULT 0,
+            builtin INTEGER NOT NULL DEFAULT 0,
+            channel_list_type INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, name)
+        )
+    ''')
+    # TABLE: reaction_groups_channel_lists
+    # channel_ids is comma-separated
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS reaction_groups_channel_lists (
+            guild_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            type INTEGER NOT NULL DEFAULT 0,
+            channel_ids TEXT NOT NULL,
+            PRIMARY KEY (guild_id, name, type)
+        )
+    ''')
+    # TABLE: jp_translations
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS jp_translations (
+            message_id INTEGER NOT NULL,
+            translated_message_id INTEGER,
+            PRIMARY KEY (message_id)
+        )
+    ''')
+
+
+def _index_reactions(cur: sqlite3.Cursor):
+    # on_raw_reaction_remove looks up a user's reactions that haven't been removed yet;
+    # it needs every column the primary key has or the planner will prefer scanning the key
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS reactions_active
+        ON reactions (message_id, channel_id, guild_id, emoji, user_id)
+        WHERE removed = 0
+    ''')
+    # /reactions first lists a message's first reactions in order
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS reactions_first
+        ON reactions (message_id, guild_id, time)
+        WHERE nth = 1
+    ''')
+
+
+def _normalize_channel_lists(cur: sqlite3.Cursor):
+    # TABLE: reaction_groups_channels
+    # One row per channel in a whitelist/blacklist, replacing the comma-separated channel_ids
+    cur.execute('''
+        CREATE TABLE reaction_groups_channels (
+            guild_id INTEGER NOT NULL,
+            list_name TEXT NOT NULL,
+            type INTEGER NOT NULL DEFAULT 0,
+            channel_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, list_name, type, channel_id)
+        )
+    ''')
+    cur.execute('''
+        CREATE INDEX reaction_groups_channels_channel
+        ON reaction_groups_channels (guild_id, channel_id)
+    ''')
+    cur.execute('''
+        SELECT guild_id, name, type, channel_ids
+        FROM reaction_groups_channel_lists
+    ''')
+    for (guild_id, name, list_type, channel_ids) in cur.fetchall():
+        for channel_id in channel_ids.split(','):
+            if channel_id.strip().isnumeric():
+                cur.execute('''
+                    INSERT OR IGNORE INTO reaction_groups_channels (guild_id, list_name, type, channel_id)
+                    VALUES (?, ?, ?, ?)
+                ''', (guild_id, name, list_type, int(channel_id)))
+    cur.execute('DROP TABLE reaction_groups_channel_lists')
+
+
+def _suspend_reaction_groups(cur: sqlite3.Cursor):
+    # Groups whose regex took too long to match are suspended and no longer evaluated at all
+    cur.execute('''
+        ALTER TABLE reaction_groups
+        ADD COLUMN suspended INTEGER NOT NULL DEFAULT 0
+    ''')
+
+
+def _cache_translations(cur: sqlite3.Cursor):
+    # TABLE: jp_translation_cache
+    # key = SHA-256 of the target language and normalized source text
+    cur.execute('''
+        CREATE TABLE jp_translation_cache (
+            key TEXT NOT NULL,
+            translation TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (key)
+        )
+    ''')
+    # Expiry and size eviction drop the oldest entries first
+    cur.execute('''
+        CREATE INDEX jp_translation_cache_created_at
+        ON jp_translation_cache (created_at)
+    ''')
+
+
+def _track_translation_edits(cur: sqlite3.Cursor):
+    # content_hash = hash of the normalized content last translated, to skip edits that didn't change it
+    cur.execute('''
+        ALTER TABLE jp_translations
+        ADD COLUMN content_hash TEXT
+    ''')
+    cur.execute('''
+        ALTER TABLE jp_translations
+        ADD COLUMN edit_count INTEGER NOT NULL DEFAULT 0
+    ''')
+
+
+def _add_translation_outbox(cur: sqlite3.Cursor):
+    # TABLE: jp_outbox
+    # Messages whose translation failed, retried in message ID order
+    cur.execute('''
+        CREATE TABLE jp_outbox (
+            message_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            guild_id INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (message_id)
+        )
+    ''')
+
+
+def _add_translation_stats(cur: sqlite3.Cursor):
+    # TABLE: jp_stats
+    # DeepL usage per guild and UTC day (YYYY-MM-DD)
+    # characters = characters sent to DeepL, cached_characters = characters served from the cache instead
+    # deduplicated = texts not sent because an identical text was in the same request
+    # skipped = texts not translated because only cached translations were being served
+    cur.execute('''
+        CREATE TABLE jp_stats (
+            guild_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            texts INTEGER NOT NULL DEFAULT 0,
+            characters INTEGER NOT NULL DEFAULT 0,
+            deduplicated INTEGER NOT NULL DEFAULT 0,
+            cache_hits INTEGER NOT NULL DEFAULT 0,
+            cached_characters INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, day)
+        )
+    ''')
+    # TABLE: jp_latency
+    # Histogram of DeepL request latencies; bucket_ms is the bucket's upper bound
+    cur.execute('''
+        CREATE TABLE jp_latency (
+            guild_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            bucket_ms INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, day, bucket_ms)
+        )
+    ''')
+
+
+def _add_pendingrole_runs(cur: sqlite3.Cursor):
+    # TABLE: pendingrole_runs
+    # Checkpoint of an unfinished /pendingrole manual run; members are fetched in pages of ascending IDs,
+    # and last_member_id is the highest ID in the last page finished, so everyone up to it has been checked
+    cur.execute('''
+        CREATE TABLE pendingrole_runs (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            last_member_id INTEGER NOT NULL DEFAULT 0,
+            processed INTEGER NOT NULL DEFAULT 0,
+            updated INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            started_at INTEGER NOT NULL,
+            PRIMARY KEY (guild_id)
+        )
+    ''')
+
+
+def _add_embed_bans(cur: sqlite3.Cursor):
+    # TABLE: embed_bans
+    # expires_at = when the embed ban role is removed, or NULL if it's permanent
+    cur.execute('''
+        CREATE TABLE embed_bans (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            banned_by INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER,
+            PRIMARY KEY (guild_id, user_id)
+        )
+    ''')
+    # Only timed bans are loaded into the expiry scheduler at startup
+    cur.execute('''
+        CREATE INDEX embed_bans_expires_at
+        ON embed_bans (expires_at)
+        WHERE expires_at IS NOT NULL
+    ''')
+
+
+def _index_failed_removals(cur: sqlite3.Cursor):
+    # Reactions the bot failed to remove are still on the message, so users can remove them themselves
+    cur.execute('DROP INDEX reactions_active')
+    cur.execute('''
+        CREATE INDEX reactions_active
+        ON reactions (message_id, channel_id, guild_id, emoji, user_id)
+        WHERE removed IN (0, 3)
+    ''')
+
+
+# Schema changes in the order they're applied; the schema version is the number applied.
+# Only ever append to this list, existing databases skip the migrations they already have.
+MIGRATIONS = [
+    _create_tables,
+    _index_reactions,
+    _normalize_channel_lists,
+    _suspend_reaction_groups,
+    _cache_translations,
+    _track_translation_edits,
+    _add_translation_outbox,
+    _add_translation_stats,
+    _add_pendingrole_runs,
+    _add_embed_bans,
+    _index_failed_removals,
+]
+
+
+def migrate(con: sqlite3.Connection):
+    """
+    Brings the database schema up to date, applying each pending migration in its own transaction.
+    The connection must be in autocommit mode (isolation_level = None).
+    """
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER NOT NULL
+        )
+    ''')
+    row = con.execute('SELECT version FROM schema_version').fetchone()
+    if row is None:
+        con.execute('INSERT INTO schema_version (version) VALUES (0)')
+    elif row[0] >= len(MIGRATIONS):
+        return
+    for (version, migration) in enumerate(MIGRATIONS, 1):
+        cur = con.cursor()
+        # Take the write lock before checking so concurrent connections don't apply a migration twice
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            if cur.execute('SELECT version FROM schema_version').fetchone()[0] >= version:
+                cur.execute('ROLLBACK')
+                continue
+            logger.info(f'Migrating database to schema version {version} ({migration.__name__})')
+            migration(cur)
+            cur.execute('UPDATE schema_version SET version = ?', (version,))
+            cur.execute('COMMIT')
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+        finally:
+            cur.close()
+
+
+class BatchWriter:
+    """
+    Queues writes to a SQLite database and commits them in batches from a dedicated thread.
+    """
+    def __init__(self, path: str, interval: float = 0.25, max_rows: int = 500):
+        self.path = path
+        self.interval = interval
+        self.max_rows = max_rows
+        # (sql, params) to write, a threading.Event to set once everything before it is
+        # committed, or None to stop the thread
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f'BatchWriter-{path}', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def execute(self, sql: str, params: tuple = ()):
+        """
+        Queues a statement to be committed with the next batch.
+        """
+        self.queue.put((sql, params))
+
+    def flush(self):
+        """
+        Blocks until every statement queued so far has been committed.
+        """
+        if not self.thread.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        """
+        Commits everything still queued and stops the writer thread.
+        """
+        atexit.unregister(self.close)
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        con = sqlite3.connect(self.path)
+        con.execute('PRAGMA journal_mode = WAL')
+        con.execute('PRAGMA synchronous = NORMAL')
+        running = True
+        while running:
+            batch = []
+            waiters = []
+            item = self.queue.get()
+            deadline = time.monotonic() + self.interval
+            while True:
+                if item is None:
+                    running = False
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.max_rows:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            self._commit(con, batch)
+            for waiter in waiters:
+                waiter.set()
+        con.close()
+
+    def _commit(self, con: sqlite3.Connection, batch: list[tuple[str, tuple]]):
+        if len(batch) == 0:
+            return
+        try:
+            with con:
+                for (sql, params) in batch:
+                    con.execute(sql, params)
+            return
+        except sqlite3.Error as e:
+            logger.warning(f'Batch of {len(batch)} writes to {self.path} failed ({e}); retrying individually')
+        # Retry one by one so a single bad row doesn't drop the whole batch
+        for (sql, params) in batch:
+            try:
+                with con:
+                    con.execute(sql, params)
+            except sqlite3.Error as e:
+                logger.error(f'Write to {self.path} failed: {e}')
+                logger.error(f'{sql.strip()} {params}')
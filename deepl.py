@@ -0,0 +1,69 @@
+import asyncio
+
+import aiohttp
+
+
+class DeepLError(Exception):
+    """
+    Raised when DeepL responds with anything but a successful translation.
+    status is the HTTP status code, or None if the request didn't complete.
+    """
+    def __init__(self, status: int | None, message: str):
+        super().__init__(f'DeepL returned status code {status}: {message}' if status is not None else message)
+        self.status = status
+
+
+class DeepL:
+    """
+    DeepL API client reusing one pooled, keep-alive session for every request.
+    """
+    def __init__(self, api_key: str, api_url: str, timeout: float = 10, max_requests: int = 4):
+        self.api_key = api_key
+        self.api_url = api_url.removesuffix('/')
+        self.timeout = timeout
+        self.max_requests = max_requests
+        self.session = None
+        # Limits in-flight requests; extra requests wait their turn instead of piling onto DeepL
+        self.requests = asyncio.Semaphore(max_requests)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session has to be created inside the running event loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers={'Authorization': 'DeepL-Auth-Key ' + self.api_key},
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.max_requests, keepalive_timeout=60))
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def _request(self, method: str, path: str, body: dict = None) -> dict:
+        async with self.requests:
+            try:
+                async with self._get_session().request(method, self.api_url + path, json=body) as r:
+                    if r.status != 200:
+                        raise DeepLError(r.status, await r.text())
+                    return await r.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise DeepLError(None, f'DeepL request failed: {e!r}')
+
+    async def translate(self, texts: list[str], source_lang: str = 'JA', target_lang: str = 'EN-US') -> list[str]:
+        """
+        Translates each text, returning the translations in the same order.
+        """
+        body = {
+            'source_lang': source_lang,
+            'target_lang': target_lang,
+            'text': texts
+        }
+        data = await self._request('POST', '/v2/translate', body)
+        return [translation['text'] for translation in data['translations']]
+
+    async def usage(self) -> tuple[int, int]:
+        """
+        Returns the characters translated this billing period and the period's character limit.
+        """
+        data = await self._request('GET', '/v2/usage')
+        return (data['character_count'], data['character_limit'])
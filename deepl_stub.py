@@ -0,0 +1,61 @@
+"""
+Local stand-in for the DeepL API, to test the jp cog without spending quota.
+Point deepl_api_url at it in config.toml, e.g. deepl_api_url = "http://127.0.0.1:8765"
+
+    python deepl_stub.py [--port 8765] [--latency-ms 50] [--status 429] [--character-limit 500000]
+"""
+import argparse
+import asyncio
+
+from aiohttp import web
+
+
+class DeepLStub:
+    """
+    Serves /v2/translate and /v2/usage like DeepL does, "translating" each text by prefixing it with
+    the target language. Every translate request fails with status if it's set.
+    """
+    def __init__(self, latency_ms: int = 50, status: int | None = None, character_limit: int = 500_000):
+        self.latency_ms = latency_ms
+        self.status = status
+        self.character_limit = character_limit
+        self.character_count = 0
+        self.requests = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v2/translate', self.translate)
+        app.router.add_get('/v2/usage', self.usage)
+        return app
+
+    async def translate(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        await asyncio.sleep(self.latency_ms / 1000)
+        if self.status is not None:
+            return web.json_response({'message': f'Stub status {self.status}'}, status=self.status)
+        texts = body['text']
+        characters = sum(len(text) for text in texts)
+        if self.character_count + characters > self.character_limit:
+            return web.json_response({'message': 'Quota exceeded'}, status=456)
+        self.character_count += characters
+        target_lang = body.get('target_lang', 'EN-US')
+        return web.json_response({'translations': [
+            {'detected_source_language': body.get('source_lang', 'JA'), 'text': f'[{target_lang}] {text}'}
+            for text in texts
+        ]})
+
+    async def usage(self, request: web.Request) -> web.Response:
+        return web.json_response({'character_count': self.character_count, 'character_limit': self.character_limit})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the DeepL API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=int, default=50, help='delay before each translation is returned')
+    parser.add_argument('--status', type=int, help='fail every translation with this status code, e.g. 429 or 456')
+    parser.add_argument('--character-limit', type=int, default=500_000, help='characters translated before returning 456')
+    args = parser.parse_args()
+    stub = DeepLStub(args.latency_ms, args.status, args.character_limit)
+    web.run_app(stub.app(), host=args.host, port=args.port)
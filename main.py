@@ -5,6 +5,8 @@ import disnake
 from disnake.ext import commands
 from loguru import logger
 
+from router import MessageRouter
+
 with open('config.toml', 'rb') as file:
     config = tomllib.load(file)
 
@@ -26,6 +28,10 @@ bot = commands.Bot(
     help_command=None,
     allowed_mentions=disnake.AllowedMentions.none())
 
+# Cogs register their message handlers per channel here instead of each listening to on_message
+router = MessageRouter()
+bot.add_listener(router.dispatch, 'on_message')
+
 @bot.event
 async def on_ready():
     logger.info(f'Logged in as {bot.user.name}#{bot.user.discriminator} ({bot.user.id})')
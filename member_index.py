@@ -0,0 +1,166 @@
+from collections import defaultdict
+
+import disnake
+
+
+class MemberIndex:
+    """
+    Trigram index over one guild's member names and display names, for ranked substring search
+    without scanning every member, and the members with each role.
+    Names are padded with two NUL characters first, so their first one or two characters
+    are trigrams too and short queries can look up prefix matches.
+    """
+    def __init__(self):
+        # member ID -> casefolded names indexed for the member
+        self.names = {}
+        # trigram -> IDs of members with a padded name containing it
+        self.trigrams = defaultdict(set)
+        # member ID -> IDs of the member's roles, not including @everyone
+        self.member_roles = {}
+        # role ID -> IDs of members with the role
+        self.roles = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @staticmethod
+    def _names(member: disnake.Member) -> tuple[str, ...]:
+        name = member.name.casefold()
+        display_name = member.display_name.casefold()
+        return (name,) if display_name == name else (name, display_name)
+
+    @staticmethod
+    def _trigrams(names: tuple[str, ...]) -> set[str]:
+        return {padded[i:i + 3] for padded in ('\0\0' + name for name in names) for i in range(len(padded) - 2)}
+
+    def add(self, member: disnake.Member):
+        """
+        Indexes the member, replacing any names and roles indexed for them before.
+        """
+        self._add_names(member)
+        self._add_roles(member)
+
+    def _add_names(self, member: disnake.Member):
+        names = self._names(member)
+        old_names = self.names.get(member.id)
+        if old_names == names:
+            return
+        old_trigrams = self._trigrams(old_names) if old_names is not None else set()
+        new_trigrams = self._trigrams(names)
+        for trigram in old_trigrams - new_trigrams:
+            self._discard(self.trigrams, trigram, member.id)
+        for trigram in new_trigrams - old_trigrams:
+            self.trigrams[trigram].add(member.id)
+        self.names[member.id] = names
+
+    def _add_roles(self, member: disnake.Member):
+        # member.roles looks up and sorts every role; the IDs are all that's needed
+        role_ids = frozenset(member._roles)
+        old_role_ids = self.member_roles.get(member.id, frozenset())
+        if old_role_ids == role_ids:
+            return
+        for role_id in old_role_ids - role_ids:
+            self._discard(self.roles, role_id, member.id)
+        for role_id in role_ids - old_role_ids:
+            self.roles[role_id].add(member.id)
+        self.member_roles[member.id] = role_ids
+
+    def remove(self, member_id: int):
+        names = self.names.pop(member_id, None)
+        if names is not None:
+            for trigram in self._trigrams(names):
+                self._discard(self.trigrams, trigram, member_id)
+        for role_id in self.member_roles.pop(member_id, ()):
+            self._discard(self.roles, role_id, member_id)
+
+    def remove_role(self, role_id: int):
+        for member_id in self.roles.pop(role_id, ()):
+            self.member_roles[member_id] = self.member_roles[member_id] - {role_id}
+
+    @staticmethod
+    def _discard(postings: dict, key, member_id: int):
+        ids = postings.get(key)
+        if ids is None:
+            return
+        ids.discard(member_id)
+        if len(ids) == 0:
+            del postings[key]
+
+    def search(self, query: str, limit: int | None = 25) -> list[int]:
+        """
+        Returns the IDs of members whose name or display name contains the query, case-insensitively.
+        Exact matches rank first, then prefix matches, then other matches; shorter names first within each.
+        """
+        query = query.casefold()
+        if len(query) == 0:
+            return []
+        if len(query) < 3:
+            # Prefix matches outrank every other match, so if there are enough of them that's the answer;
+            # otherwise scan the already casefolded names for the rest
+            prefixed = self.trigrams.get('\0' * (3 - len(query)) + query, ())
+            if limit is not None and len(prefixed) >= limit:
+                return self._rank(query, prefixed, limit)
+            return self._rank(query, self.names.keys(), limit)
+        postings = []
+        for i in range(len(query) - 2):
+            ids = self.trigrams.get(query[i:i + 3])
+            if ids is None:
+                return []
+            postings.append(ids)
+        postings.sort(key=len)
+        return self._rank(query, postings[0].intersection(*postings[1:]), limit)
+
+    def _rank(self, query: str, candidates, limit: int | None) -> list[int]:
+        ranked = []
+        for member_id in candidates:
+            best = None
+            for name in self.names[member_id]:
+                if query not in name:
+                    continue
+                rank = (0 if name == query else 1 if name.startswith(query) else 2, len(name))
+                if best is None or rank < best:
+                    best = rank
+            if best is not None:
+                ranked.append((best, member_id))
+        ranked.sort()
+        return [member_id for (_, member_id) in ranked[:limit]]
+
+
+# guild ID -> MemberIndex, maintained by the Members cog
+indexes = {}
+
+
+def search_members(guild: disnake.Guild, query: str, limit: int | None = 25) -> list[disnake.Member]:
+    """
+    Returns the guild's members whose name or display name contains the query, best matches first.
+    Falls back to scanning the member cache if the guild isn't indexed yet.
+    """
+    index = indexes.get(guild.id)
+    if index is None:
+        query = query.casefold()
+        return [member for member in guild.members
+                if query in member.name.casefold() or query in member.display_name.casefold()][:limit]
+    members = []
+    for member_id in index.search(query, limit):
+        member = guild.get_member(member_id)
+        if member is not None:
+            members.append(member)
+    return members
+
+
+def role_member_ids(guild: disnake.Guild, role: disnake.Role) -> list[int]:
+    """
+    Returns the IDs of the members with the role, in ascending order.
+    Falls back to scanning the member cache if the guild isn't indexed yet.
+    """
+    index = indexes.get(guild.id)
+    if index is None:
+        return sorted(member.id for member in role.members)
+    return sorted(index.roles.get(role.id, ()))
+
+
+def member_choices(guild: disnake.Guild, query: str) -> dict[str, str]:
+    """
+    Slash command autocomplete for members; the chosen value is the member's ID.
+    """
+    return {f'{member.display_name} ({member.name})'[:100]: str(member.id) for member in search_members(guild, query, 25)}
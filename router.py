@@ -0,0 +1,64 @@
+import asyncio
+from typing import Awaitable, Callable
+
+import disnake
+from loguru import logger
+
+MessageHandler = Callable[[disnake.Message], Awaitable[None]]
+
+
+class MessageRouter:
+    """
+    Single on_message listener that hands guild messages from non-bot authors to the handlers
+    registered for their channel, so a message nothing is interested in costs a dict lookup.
+    """
+    def __init__(self):
+        # (guild ID, channel ID) -> handlers for messages in that channel
+        self.channel_routes = {}
+        # guild ID -> handlers for messages in every channel of the guild
+        self.guild_routes = {}
+
+    def register(self, guild_id: int, channel_id: int | None, handler: MessageHandler):
+        """
+        Routes messages in the channel to the handler, or every message in the guild if channel_id is None.
+        """
+        if channel_id is None:
+            self.guild_routes.setdefault(guild_id, []).append(handler)
+        else:
+            self.channel_routes.setdefault((guild_id, channel_id), []).append(handler)
+
+    def unregister(self, handler: MessageHandler):
+        """
+        Removes every route to the handler.
+        """
+        for routes in (self.channel_routes, self.guild_routes):
+            for key in list(routes):
+                handlers = [h for h in routes[key] if h != handler]
+                if len(handlers) > 0:
+                    routes[key] = handlers
+                else:
+                    del routes[key]
+
+    async def dispatch(self, message: disnake.Message):
+        if message.guild is None or message.author.bot:
+            return
+        handlers = self.channel_routes.get((message.guild.id, message.channel.id))
+        guild_handlers = self.guild_routes.get(message.guild.id)
+        if handlers is None:
+            if guild_handlers is None:
+                return
+            handlers = guild_handlers
+        elif guild_handlers is not None:
+            handlers = handlers + guild_handlers
+        if len(handlers) == 1:
+            await self._run(handlers[0], message)
+        else:
+            # Handlers run side by side, like separate listeners would
+            await asyncio.gather(*(self._run(handler, message) for handler in handlers))
+
+    @staticmethod
+    async def _run(handler: MessageHandler, message: disnake.Message):
+        try:
+            await handler(message)
+        except Exception:
+            logger.exception(f'Message handler {handler.__qualname__} failed on message {message.id}')
@@ -1,5 +1,15 @@
+import asyncio
+import re
+from collections import OrderedDict
+from typing import Awaitable, Callable, TypeVar
+
+import disnake
+from loguru import logger
+
 from main import config
 
+T = TypeVar('T')
+
 
 def get_guild_config(guild_id: int, cog: str) -> dict or None:
     """
@@ -17,3 +27,54 @@ def get_dual_timestamps(timestamp: str) -> str:
     Returns a string with the formatted date and long time of the given timestamp.
     """
     return f'<t:{timestamp}:d> <t:{timestamp}:T>'
+
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parsetime(duration: str) -> int:
+    """
+    Returns the number of seconds in a duration like 30m, 12h or 1w2d.
+    Raises ValueError if it isn't one.
+    """
+    duration = duration.strip().lower()
+    if re.fullmatch(r'(?:\d+\s*[smhdw]\s*)+', duration) is None:
+        raise ValueError(f'Invalid duration: {duration}')
+    return sum(int(amount) * DURATION_UNITS[unit] for (amount, unit) in re.findall(r'(\d+)\s*([smhdw])', duration))
+
+
+async def retry_rate_limited(call: Callable[[], Awaitable[T]], attempts: int, pause: float, action: str) -> T:
+    """
+    Returns the result of call(), calling it again after pause seconds while Discord rate limits it,
+    up to attempts calls in all. disnake already waits out rate limits, so a 429 here means it gave up retrying.
+    Raises the last disnake.HTTPException once attempts run out, or any other error straight away.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await call()
+        except disnake.HTTPException as e:
+            if e.status != 429 or attempt == attempts:
+                raise
+            logger.warning(f'Still rate limited {action}; retrying in {pause}s (attempt {attempt}/{attempts})')
+            await asyncio.sleep(pause)
+
+
+class LRUCache(OrderedDict):
+    """
+    A dict that evicts its least recently used entries past maxsize.
+    """
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)